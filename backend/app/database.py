@@ -1,19 +1,42 @@
 """SQLite-backed database utilities for the phishing detector."""
 from __future__ import annotations
 
+import logging
+import threading
+import types
+import weakref
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
-from sqlalchemy import create_engine, func, select, text
+from sqlalchemy import create_engine, event, func, insert, select, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, sessionmaker
 
 from models import Base, EmailEvent, Prediction, TrustedDomain, User
 
+logger = logging.getLogger(__name__)
+
 _DB_PATH = Path(__file__).resolve().parents[2] / "phishing_detector.db"
 DATABASE_URL = f"sqlite:///{_DB_PATH}"
 
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """WAL + NORMAL sync: commits no longer fsync the main database file."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in _SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
 
 class DatabaseManager:
     """High-level database helper that wraps SQLAlchemy sessions."""
@@ -25,14 +48,21 @@ class DatabaseManager:
             future=True,
             connect_args={"check_same_thread": False},
         )
+        event.listen(self.engine, "connect", _apply_sqlite_pragmas)
         Base.metadata.create_all(self.engine)
         self._migrate_remove_mobile_unique()
         self._migrate_add_email_alerts()
+        self._migrate_add_indexes()
+        self._migrate_normalize_enum_values()
         self._Session = sessionmaker(
             bind=self.engine,
             future=True,
             expire_on_commit=False,
         )
+        # References that return the callback, or None once a weakly held
+        # bound method's object is gone.
+        self._trust_listeners: List[Callable[[], Optional[Callable[[int], None]]]] = []
+        self._trust_listeners_lock = threading.Lock()
 
     def _migrate_remove_mobile_unique(self) -> None:
         with self.engine.connect() as conn:
@@ -82,6 +112,51 @@ class DatabaseManager:
                 conn.execute(text('ALTER TABLE "User" ADD COLUMN "emailAlertsEnabled" BOOLEAN NOT NULL DEFAULT 0'))
                 conn.commit()
 
+    def _migrate_normalize_enum_values(self) -> None:
+        # SQLite gets no CHECK constraint for the Enum columns, so rows written
+        # before they were declared may hold other spellings. Loading such a
+        # row raises LookupError, so map them onto the enum values: case and
+        # whitespace are normalised, "legit" becomes "legitimate", and anything
+        # else is derived from phishingProbability with the SMTP server's
+        # thresholds (unknown roles become "normal").
+        statements = (
+            """
+            UPDATE "User" SET role =
+                CASE WHEN lower(trim(role)) = 'admin' THEN 'admin' ELSE 'normal' END
+            WHERE role IS NOT NULL AND role NOT IN ('normal', 'admin')
+            """,
+            """
+            UPDATE "Prediction" SET predictedLabel =
+                CASE
+                    WHEN lower(trim(predictedLabel)) = 'phishing' THEN 'phishing'
+                    WHEN lower(trim(predictedLabel)) IN ('legitimate', 'legit') THEN 'legitimate'
+                    WHEN phishingProbability >= 0.5 THEN 'phishing'
+                    ELSE 'legitimate'
+                END
+            WHERE predictedLabel NOT IN ('phishing', 'legitimate')
+            """,
+            """
+            UPDATE "Prediction" SET riskLevel =
+                CASE
+                    WHEN upper(trim(riskLevel)) IN ('LOW', 'MEDIUM', 'HIGH') THEN upper(trim(riskLevel))
+                    WHEN phishingProbability >= 0.85 THEN 'HIGH'
+                    WHEN phishingProbability >= 0.55 THEN 'MEDIUM'
+                    ELSE 'LOW'
+                END
+            WHERE riskLevel NOT IN ('LOW', 'MEDIUM', 'HIGH')
+            """,
+        )
+        with self.engine.begin() as conn:
+            fixed = sum(conn.execute(text(statement)).rowcount for statement in statements)
+        if fixed:
+            logger.warning("Normalised %d legacy role/label/risk values to the enum values", fixed)
+
+    def _migrate_add_indexes(self) -> None:
+        # create_all() only builds indexes together with new tables.
+        with self.engine.begin() as conn:
+            for index in EmailEvent.__table__.indexes:
+                index.create(conn, checkfirst=True)
+
     @contextmanager
     def _session_scope(self) -> Session:
         session = self._Session()
@@ -158,40 +233,157 @@ class DatabaseManager:
             return enabled
 
     def log_email_event(self, user_id, sender_domain, is_forwarded=False, message_id_hash=None):
-        if message_id_hash:
-            with self._session_scope() as session:
-                existing = session.scalar(
-                    select(EmailEvent).where(EmailEvent.messageIdHash == message_id_hash)
-                )
-                if existing:
-                    return existing
+        return self.log_email_events_bulk([
+            {
+                "user_id": user_id,
+                "sender_domain": sender_domain,
+                "is_forwarded": is_forwarded,
+                "message_id_hash": message_id_hash,
+            }
+        ])[0]
+
+    def log_email_events_bulk(self, rows: List[Dict[str, object]]) -> List[EmailEvent]:
+        """Insert many email events in a single transaction.
+
+        Each row takes the keyword arguments of ``log_email_event``. A row whose
+        ``message_id_hash`` is already stored (or appears earlier in the batch)
+        resolves to that existing event instead of inserting a duplicate.
+        Results are returned in the same order as ``rows``.
+        """
+        if not rows:
+            return []
         with self._session_scope() as session:
-            event = EmailEvent(
-                userId=user_id,
-                senderDomain=sender_domain,
-                isForwarded=is_forwarded,
-                messageIdHash=message_id_hash,
+            return self._insert_email_events(session, rows)
+
+    def _insert_email_events(self, session: Session, rows: List[Dict[str, object]]) -> List[EmailEvent]:
+        hashes = {r["message_id_hash"] for r in rows if r.get("message_id_hash")}
+        by_hash: Dict[str, EmailEvent] = {}
+        if hashes:
+            by_hash = {
+                event.messageIdHash: event
+                for event in session.scalars(
+                    select(EmailEvent).where(EmailEvent.messageIdHash.in_(hashes))
+                )
+            }
+
+        params: List[Dict[str, object]] = []
+        pending_hashes = set()
+        for r in rows:
+            message_id_hash = r.get("message_id_hash")
+            if message_id_hash:
+                if message_id_hash in by_hash or message_id_hash in pending_hashes:
+                    continue
+                pending_hashes.add(message_id_hash)
+            params.append(
+                {
+                    "userId": r["user_id"],
+                    "senderDomain": r["sender_domain"],
+                    "isForwarded": r.get("is_forwarded", False),
+                    "messageIdHash": message_id_hash,
+                }
             )
-            session.add(event)
-            return event
+
+        inserted: List[EmailEvent] = []
+        if params:
+            inserted = list(
+                session.scalars(
+                    insert(EmailEvent).returning(EmailEvent, sort_by_parameter_order=True),
+                    params,
+                )
+            )
+
+        events: List[EmailEvent] = []
+        new_events = iter(inserted)
+        for r in rows:
+            message_id_hash = r.get("message_id_hash")
+            if message_id_hash and message_id_hash in by_hash:
+                events.append(by_hash[message_id_hash])
+                continue
+            event = next(new_events)
+            if message_id_hash:
+                by_hash[message_id_hash] = event
+            events.append(event)
+        return events
 
     def log_prediction(self, email_event_id, model_version, phishing_prob, predicted_label, risk_level):
+        return self.log_predictions_bulk([
+            {
+                "email_event_id": email_event_id,
+                "model_version": model_version,
+                "phishing_prob": phishing_prob,
+                "predicted_label": predicted_label,
+                "risk_level": risk_level,
+            }
+        ])[0]
+
+    def log_predictions_bulk(self, rows: List[Dict[str, object]]) -> List[Optional[Prediction]]:
+        """Insert many predictions in a single transaction.
+
+        Each row takes the keyword arguments of ``log_prediction``. Events that
+        already have a prediction (in the database or earlier in the batch) get
+        ``None`` at their position. Raises ``ValueError`` and inserts nothing if
+        any referenced event does not exist.
+        """
+        if not rows:
+            return []
         with self._session_scope() as session:
-            if not session.get(EmailEvent, email_event_id):
-                raise ValueError("EmailEvent does not exist")
-
-            if session.scalar(select(Prediction).where(Prediction.emailEventId == email_event_id)):
-                return None
-
-            prediction = Prediction(
-                emailEventId=email_event_id,
-                modelVersion=model_version,
-                phishingProbability=phishing_prob,
-                predictedLabel=predicted_label,
-                riskLevel=risk_level,
+            return self._insert_predictions(session, rows)
+
+    def _insert_predictions(self, session: Session, rows: List[Dict[str, object]]) -> List[Optional[Prediction]]:
+        event_ids = {r["email_event_id"] for r in rows}
+        found = set(session.scalars(select(EmailEvent.id).where(EmailEvent.id.in_(event_ids))))
+        if found != event_ids:
+            raise ValueError("EmailEvent does not exist")
+
+        taken = set(
+            session.scalars(
+                select(Prediction.emailEventId).where(Prediction.emailEventId.in_(event_ids))
+            )
+        )
+        params: List[Dict[str, object]] = []
+        for r in rows:
+            if r["email_event_id"] in taken:
+                continue
+            taken.add(r["email_event_id"])
+            params.append(
+                {
+                    "emailEventId": r["email_event_id"],
+                    "modelVersion": r["model_version"],
+                    "phishingProbability": r["phishing_prob"],
+                    "predictedLabel": r["predicted_label"],
+                    "riskLevel": r["risk_level"],
+                }
             )
-            session.add(prediction)
-            return prediction
+
+        inserted: Dict[int, Prediction] = {}
+        if params:
+            inserted = {
+                prediction.emailEventId: prediction
+                for prediction in session.scalars(
+                    insert(Prediction).returning(Prediction, sort_by_parameter_order=True),
+                    params,
+                )
+            }
+
+        # pop() so only the first row for an event receives its new prediction.
+        return [inserted.pop(r["email_event_id"], None) for r in rows]
+
+    def log_scans_bulk(self, rows: List[tuple[Dict[str, object], Dict[str, object]]]) -> List[EmailEvent]:
+        """Insert ``(event, prediction)`` row pairs in a single transaction.
+
+        Rows take the keyword arguments of ``log_email_event`` and
+        ``log_prediction`` (without ``email_event_id``). Either every pair is
+        stored or, if anything fails, nothing is, so a failed batch can be retried.
+        """
+        if not rows:
+            return []
+        with self._session_scope() as session:
+            events = self._insert_email_events(session, [event_row for event_row, _ in rows])
+            self._insert_predictions(session, [
+                dict(prediction_row, email_event_id=event.id)
+                for (_, prediction_row), event in zip(rows, events)
+            ])
+            return events
 
     def is_trusted_domain(self, user_id, domain):
         with self._session_scope() as session:
@@ -205,6 +397,34 @@ class DatabaseManager:
                 is not None
             )
 
+    def get_trusted_domain_set(self, user_id: int) -> frozenset[str]:
+        """Return the names of all domains a user trusts."""
+        with self._session_scope() as session:
+            return frozenset(
+                session.scalars(select(TrustedDomain.domain).where(TrustedDomain.userId == user_id))
+            )
+
+    def add_trust_listener(self, callback: Callable[[int], None]) -> None:
+        """Call ``callback(user_id)`` after that user's trusted domains change.
+
+        Bound methods are held weakly, so registering one does not keep its
+        object alive; the listener goes away with it.
+        """
+        if isinstance(callback, types.MethodType):
+            ref = weakref.WeakMethod(callback)
+        else:
+            ref = lambda: callback
+        with self._trust_listeners_lock:
+            self._trust_listeners.append(ref)
+
+    def invalidate_user_trust(self, user_id: int) -> None:
+        with self._trust_listeners_lock:
+            live = [(ref, ref()) for ref in self._trust_listeners]
+            live = [(ref, callback) for ref, callback in live if callback is not None]
+            self._trust_listeners = [ref for ref, _ in live]
+        for _, callback in live:
+            callback(user_id)
+
     def add_trusted_domain(self, user_id, domain, reason=""):
         with self._session_scope() as session:
             existing = session.scalar(
@@ -222,7 +442,9 @@ class DatabaseManager:
                 reason=reason,
             )
             session.add(trusted)
-            return trusted
+        # Listeners run after the commit, so a reload sees the new row.
+        self.invalidate_user_trust(user_id)
+        return trusted
 
     def get_user_trusted_domains(self, user_id: int) -> list[dict]:
         """Return all trusted domains for a user."""
@@ -254,7 +476,8 @@ class DatabaseManager:
             if not row:
                 return False
             session.delete(row)
-            return True
+        self.invalidate_user_trust(user_id)
+        return True
 
     def get_user_summary(self, user_id: int, trend_days: int = 14) -> Dict[str, object]:
         """Return per-user aggregate stats + daily trend data.
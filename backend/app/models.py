@@ -6,6 +6,7 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
@@ -23,7 +24,7 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     emailHash = Column(String, unique=True, nullable=False)
     passwordHash = Column(String, nullable=False)
-    role = Column(String, default="normal")
+    role = Column(Enum("normal", "admin", name="role_enum", validate_strings=True), default="normal")
     firstName = Column(String)
     lastName = Column(String)
     mobileNumber = Column(String)
@@ -49,6 +50,10 @@ class EmailEvent(Base):
     user = relationship("User", back_populates="emailEvents")
     prediction = relationship("Prediction", back_populates="emailEvent", uselist=False)
 
+    # Serves the per-user history query (filter on userId, newest first).
+    # Prediction.emailEventId is already indexed by its unique constraint.
+    __table_args__ = (Index("ix_emailevent_user_recv", "userId", "receivedAt"),)
+
 
 class Prediction(Base):
     __tablename__ = "Prediction"
@@ -57,8 +62,12 @@ class Prediction(Base):
     emailEventId = Column(Integer, ForeignKey("EmailEvent.id"), unique=True)
     modelVersion = Column(String, nullable=False)
     phishingProbability = Column(Float, nullable=False)
-    predictedLabel = Column(String, nullable=False)
-    riskLevel = Column(String, nullable=False)
+    # validate_strings: SQLite has no CHECK constraint for these, so bad
+    # values are refused on write; DatabaseManager normalises legacy rows.
+    predictedLabel = Column(
+        Enum("phishing", "legitimate", name="label_enum", validate_strings=True), nullable=False
+    )
+    riskLevel = Column(Enum("LOW", "MEDIUM", "HIGH", name="risk_enum", validate_strings=True), nullable=False)
     createdAt = Column(DateTime, default=func.now())
 
     emailEvent = relationship("EmailEvent", back_populates="prediction")
@@ -1,14 +1,698 @@
 ﻿import asyncio
+import functools
+import hashlib
+import logging
+import logging.handlers
+import queue
 import re
 import os
-from email import message_from_bytes, policy
+import sys
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
 from email.parser import BytesParser
 from aiosmtpd.controller import Controller
 import joblib
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.utils.sparsefuncs_fast import inplace_csr_row_normalize_l2
 from pathlib import Path
-from bs4 import BeautifulSoup, Comment
+try:
+    from lxml import etree
+except ImportError:  # BeautifulSoup, then the regex fallback, take over
+    etree = None
+try:
+    from bs4 import BeautifulSoup, Comment
+except ImportError:
+    BeautifulSoup = Comment = None
 import html
 
+logger = logging.getLogger(__name__)
+
+PREDICTION_CACHE_SIZE = 2048
+INFERENCE_BATCH_SIZE = 32
+INFERENCE_WORKERS = os.cpu_count() or 1
+# Text past these lengths is dropped before the main text cleanup runs
+MAX_BODY_CHARS = 50_000
+MAX_SUBJECT_CHARS = 4096
+
+_EMAIL_ADDR = r'[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,}'
+
+# get_original_sender. "Forwarded [message] from: x" needs no pattern of its
+# own: it always contains a "from: x" match, which is searched first.
+_RE_SENDER_FROM = re.compile(r'from[:\s]+<?(' + _EMAIL_ADDR + r')>?', re.IGNORECASE)
+_RE_SENDER_ORIGINALLY = re.compile(r'originally\s+sent\s+by[:\s]+<?(' + _EMAIL_ADDR + r')>?', re.IGNORECASE)
+_RE_EMAIL_ADDR = re.compile(r'(' + _EMAIL_ADDR + r')', re.IGNORECASE)
+
+# _remove_invisible_unicode
+_RE_SOFT_HYPHEN_JOIN = re.compile(r'(\S)\u00AD(\S)')
+_RE_DOUBLE_SPACE = re.compile(r'  +')
+
+
+def _mail_header_re(names):
+    return re.compile(r'^\s*(?:' + '|'.join(names) + r'):\s*.+?$', re.MULTILINE | re.IGNORECASE)
+
+
+def _strip_mail_headers(text, header_re=None):
+    """Drop ``To:``/``From:``/``Subject:``-style header lines quoted in a body."""
+    return (header_re or _RE_MAIL_HEADER).sub('', text)
+
+
+def _translate_table(to_space, to_drop):
+    """Build a ``str.translate`` table from inclusive code point ranges."""
+    table = {}
+    for first, last in to_space:
+        table.update(dict.fromkeys(range(first, last + 1), ' '))
+    for first, last in to_drop:
+        table.update(dict.fromkeys(range(first, last + 1)))
+    return table
+
+
+_ZERO_WIDTH = [(0x200B, 0x200D), (0xFEFF, 0xFEFF)]
+_BIDI_CONTROLS = [(0x200E, 0x200F), (0x202A, 0x202E), (0x2060, 0x2060), (0x180E, 0x180E), (0x061C, 0x061C)]
+_WIDE_SPACES = [(0x00A0, 0x00A0), (0x2002, 0x2003), (0x2009, 0x200A), (0x202F, 0x202F)]
+
+# Zero-width, bidi and wide-space characters become a space; soft hyphens
+# and combining marks are dropped. One pass instead of a chain of replaces.
+_INVISIBLE_TBL = _translate_table(
+    _ZERO_WIDTH + _BIDI_CONTROLS + _WIDE_SPACES,
+    [(0x00AD, 0x00AD), (0x0300, 0x036F), (0x0483, 0x0489), (0x115F, 0x1160)],
+)
+
+# Shared by _remove_email_artifacts and _clean_forwarded_body
+_MAIL_HEADER_NAMES = ('To', 'From', 'Date', 'Sent', 'Cc', 'Bcc', 'Subject', 'Reply-To')
+_RE_MAIL_HEADER = _mail_header_re(_MAIL_HEADER_NAMES)
+# Forwarded content also carries delivery headers. Stripping these from the
+# whole body would eat forward markers that share their line.
+_RE_FWD_MAIL_HEADER = _mail_header_re(_MAIL_HEADER_NAMES + ('Delivered-To', 'Return-Path'))
+_RE_ON_WROTE_LINE = re.compile(r'^On\s+.+?wrote:\s*$', re.MULTILINE | re.IGNORECASE)
+_RE_QUOTED_LINE = re.compile(r'^[>|]\s*.+?$', re.MULTILINE)
+_RE_DATA_IMAGE = re.compile(r'data:image/[^;]+;base64,[^\s]+')
+_RE_BLANK_LINES = re.compile(r'\n{3,}')
+
+# _remove_email_artifacts
+_RE_STYLE_ATTR = re.compile(r'style\s*=\s*["\'][^"\']{0,200}["\']', re.IGNORECASE)
+_RE_MEDIA_RULE = re.compile(r'@media[^{]*\{[^}]*\}', re.IGNORECASE)
+_RE_AT_RULE = re.compile(r'@[a-z-]+\s+[^{]*\{[^}]*\}', re.IGNORECASE)
+_RE_CLASS_ATTR = re.compile(r'class\s*=\s*["\'][^"\']+["\']', re.IGNORECASE)
+_RE_ID_ATTR = re.compile(r'id\s*=\s*["\'][^"\']+["\']', re.IGNORECASE)
+_RE_IMAGE_URL = re.compile(r'https?://[^\s]*\.(?:png|jpg|gif|jpeg)\?[^\s]*', re.IGNORECASE)
+_RE_MIME_BOUNDARY = re.compile(r'--\s*\w+\s*(?:boundary|delimiter)\s*--', re.IGNORECASE)
+_RE_HSPACE = re.compile(r'[ \t]+')
+
+# _html_to_text
+_HTML_DROP_TAGS = frozenset(('script', 'style', 'head', 'meta', 'link'))
+_HTML_PRESERVE_TAGS = frozenset(('pre', 'textarea'))
+_ASCII_SPACES = ' \t\n\r\f'
+
+
+class _HTMLTextCollector:
+    """lxml parser target that gathers visible text straight from parse events.
+
+    Text is split into strings at every tag, comment and doctype, then joined
+    with a space. Whitespace-only strings collapse to a single newline or
+    space outside <pre>/<textarea>, so the result matches BeautifulSoup's
+    ``get_text(separator=' ')`` without building a tree. Event-driven parsing
+    also keeps content that follows ``</html>``, which lxml's tree builder
+    drops.
+    """
+    
+    def __init__(self):
+        self._strings = []
+        self._pending = []
+        self._skip_depth = 0
+        self._preserve_depth = 0
+    
+    def _flush(self):
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        if self._skip_depth:
+            return
+        if not self._preserve_depth and not text.strip(_ASCII_SPACES):
+            text = '\n' if '\n' in text else ' '
+        self._strings.append(text)
+    
+    def start(self, tag, attrib):
+        self._flush()
+        if tag in _HTML_DROP_TAGS:
+            self._skip_depth += 1
+        elif tag in _HTML_PRESERVE_TAGS:
+            self._preserve_depth += 1
+    
+    def end(self, tag):
+        self._flush()
+        if tag in _HTML_DROP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in _HTML_PRESERVE_TAGS and self._preserve_depth:
+            self._preserve_depth -= 1
+    
+    def data(self, data):
+        self._pending.append(data)
+    
+    def comment(self, text):
+        self._flush()
+    
+    def doctype(self, *args):
+        self._flush()
+    
+    def pi(self, *args):
+        self._flush()
+    
+    def close(self):
+        self._flush()
+        return ' '.join(self._strings)
+
+# _html_to_text_fallback
+_RE_HTML_SCRIPT = re.compile(r'<script[^>]*>.*?</script>', re.DOTALL | re.IGNORECASE)
+_RE_HTML_STYLE = re.compile(r'<style[^>]*>.*?</style>', re.DOTALL | re.IGNORECASE)
+_RE_HTML_HEAD = re.compile(r'<head[^>]*>.*?</head>', re.DOTALL | re.IGNORECASE)
+_RE_HTML_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_RE_HTML_BLOCK_END = re.compile(r'</(div|p|br|tr|h[1-6]|li)[^>]*>', re.IGNORECASE)
+_RE_HTML_TAG = re.compile(r'<[^>]+>')
+
+# _extract_forwarded_content
+_RE_FWD_FROM_TAG = re.compile(r'from:', re.IGNORECASE)
+_RE_FWD_SUBJECT_TAG = re.compile(r'(?<=\n)subject:', re.IGNORECASE)
+_RE_LEADING_WS = re.compile(r'\s*')
+_RE_FWD_SUBJECT_LINE = re.compile(r'\n\s*Subject:\s*(.+?)(?:\n|$)', re.IGNORECASE)
+
+
+
+def _find_forwarded_header_block(body):
+    r"""Locate a forwarded ``From: ... Subject: ...`` header block in ``body``.
+
+    Returns ``(subject, content_after_headers)`` or None, exactly as the
+    DOTALL search ``From:\s*.+?\n(?:.*?\n)*?Subject:\s*(.+?)\r?\n(.+)``
+    would, without its exponential backtracking when a From: is followed
+    by many lines and no usable Subject:.
+
+    Only the first ``from:`` matters; a later one could only see a subset of
+    the same Subject lines. A Subject line is usable while a newline with
+    text after it still follows. The greedy ``\s*`` after ``From:`` means
+    Subject lines beyond its whitespace run are tried first, in order, then
+    those inside it from the last one back.
+    """
+    from_tag = _RE_FWD_FROM_TAG.search(body)
+    if not from_tag:
+        return None
+    
+    last_newline = body.rfind('\n', 0, len(body) - 1)
+    header_end = from_tag.end()
+    ws_end = _RE_LEADING_WS.match(body, header_end).end()
+    
+    subject_at = None
+    for tag in _RE_FWD_SUBJECT_TAG.finditer(body, header_end + 2):
+        if tag.start() > last_newline - 9:
+            break
+        subject_at = tag.start()
+        if subject_at >= ws_end + 2:
+            break
+    if subject_at is None:
+        return None
+    
+    start = _RE_LEADING_WS.match(body, subject_at + len('subject:')).end()
+    newline = body.find('\n', start + 1)
+    if newline != -1 and newline + 1 < len(body):
+        end = newline - 1 if newline - 1 > start and body[newline - 1] == '\r' else newline
+        return body[start:end], body[newline + 1:]
+    # Only the newline in the whitespace after Subject: is left, so the
+    # subject is the single character before it.
+    return body[last_newline - 1:last_newline], body[last_newline + 1:]
+
+# _clean_forwarded_body
+_RE_FWD_NOISE_URL = re.compile(
+    r'https?://[^\s]+\.(?:png|jpg|gif|jpeg|svg)\?[^\s]*'
+    r'|https?://[^\s]*(?:track|click|pixel|beacon|analytics|utm_)[^\s]*',
+    re.IGNORECASE,
+)
+_RE_FWD_VIEW_ONLINE = re.compile(r'(?:view|read|open).{0,30}(?:browser|web|online)', re.IGNORECASE)
+_RE_FWD_UNSUBSCRIBE = re.compile(r'(?:unsubscribe|manage\s+preferences|update\s+settings)', re.IGNORECASE)
+_RE_FWD_CALL_TO_ACTION = re.compile(r'(?:click\s+here|tap\s+here|learn\s+more)', re.IGNORECASE)
+_RE_FWD_SUBREDDIT = re.compile(r'r/[a-z0-9_]+:', re.IGNORECASE)
+_RE_FWD_NEWSLETTER = re.compile(r'subscribe\s+to\s+our\s+newsletter', re.IGNORECASE)
+_RE_FWD_FOLLOW_US = re.compile(r'follow\s+us\s+on', re.IGNORECASE)
+_RE_FWD_EQUALS_RUN = re.compile(r'={3,}')
+_RE_FWD_RULE_RUN = re.compile(r'[-_]{5,}')
+_RE_FWD_SENT_FROM = re.compile(r'^\s*Sent from my .+$', re.MULTILINE | re.IGNORECASE)
+_RE_FWD_GET_OUTLOOK = re.compile(r'^\s*Get Outlook for .+$', re.MULTILINE | re.IGNORECASE)
+
+# _remove_signatures: everything from the earliest signature marker onwards
+_RE_SIGNATURE = re.compile(
+    r'\n(?:--\s*\n|_{10,}|={10,}|Best regards|Thanks|Sent from).*$',
+    re.DOTALL | re.IGNORECASE,
+)
+
+# _clean_text
+# Same idea for _clean_text, which also turns soft hyphens into spaces and
+# drops Hebrew, Arabic and Syriac points plus Hangul/Khmer/Mongolian fillers.
+_CLEAN_TBL = _translate_table(
+    _ZERO_WIDTH + _BIDI_CONTROLS + _WIDE_SPACES + [(0x00AD, 0x00AD)],
+    [
+        (0x0300, 0x036F), (0x0483, 0x0489),
+        (0x0591, 0x05BD), (0x05BF, 0x05BF), (0x05C1, 0x05C2), (0x05C4, 0x05C5), (0x05C7, 0x05C7),
+        (0x0610, 0x061A), (0x064B, 0x065F), (0x0670, 0x0670),
+        (0x06D6, 0x06DC), (0x06DF, 0x06E4), (0x06E7, 0x06E8), (0x06EA, 0x06ED),
+        (0x0711, 0x0711), (0x0730, 0x074A), (0x07A6, 0x07B0), (0x07EB, 0x07F3),
+        (0x115F, 0x1160), (0x17B4, 0x17B5), (0x180B, 0x180D),
+    ],
+)
+_RE_ENTITY = re.compile(r'&(?:[a-z]+|#\d+|#x[0-9a-f]+);', re.IGNORECASE)
+_RE_CSS_BLOCK = re.compile(r'\w+\s*\{[^}]+\}')
+# Everything below runs on lowercased text, so no IGNORECASE is needed.
+_RE_CSS_SUP = re.compile(r'sup\s*\{[^}]+\}')
+_RE_CSS_IMPORTANT = re.compile(r'[a-z-]+\s*:\s*[^;{}\n]+\s*!important\s*;?')
+_RE_CSS_DECL = re.compile(r'[a-z-]+\s*:\s*[^;{}\n]+;')
+_GARBAGE_CHARS = '{}!;%@#~^*'
+_RE_GARBAGE = re.compile('[' + re.escape(_GARBAGE_CHARS) + ']')
+# Indexed by code point; only used on ASCII text, where translate is a table copy
+_GARBAGE_TBL = ''.join(' ' if c in _GARBAGE_CHARS else c for c in map(chr, range(128)))
+_RE_SUBREDDIT = re.compile(r'\br/[a-z0-9_]+\b\s*:?\s*')
+_RE_BOILERPLATE = re.compile(
+    r'(?:view|read|open)\s+(?:this\s+)?(?:email|message|newsletter)\s+(?:in|on)\s+(?:your\s+)?(?:browser|web)'
+    r'|(?:unsubscribe|manage\s+preferences|update\s+email|update\s+settings)'
+)
+_RE_NOISE_URL = re.compile(
+    r'https?://[^\s]+\?[^\s]+'
+    r'|https?://[^\s]*(?:track|pixel|beacon|analytics|click)[^\s]*'
+)
+_RE_EMAIL_WORD = re.compile(r'\b' + _EMAIL_ADDR + r'\b')
+_RE_HEX_TOKEN = re.compile(r'\b[a-f0-9]{32,}\b')
+_RE_BASE64_TOKEN = re.compile(r'\b[A-Za-z0-9+/]{40,}={0,2}\b')
+_RE_SEPARATOR_RUN = re.compile(r'[_=\-|\\\/]{3,}')
+_RE_ELLIPSIS_RUN = re.compile(r'\.{3,}')
+_RE_SENT_FROM_MY = re.compile(r'sent\s+from\s+my\s+\w+')
+_RE_ON_WROTE = re.compile(r'on\s+.+?wrote:')
+_RE_LONG_NUMBER = re.compile(r'\b\d{10,}\b')
+# Single-character tokens kept by _clean_text
+_MEANINGFUL = frozenset(('i', 'a'))
+
+
+def get_original_sender(raw_body, email_msg=None):
+    match = _RE_SENDER_FROM.search(raw_body) or _RE_SENDER_ORIGINALLY.search(raw_body)
+    if match:
+        return match.group(1).lower()
+    
+    if email_msg:
+        original_from = email_msg.get('X-Original-From', '')
+        if original_from:
+            email_match = _RE_EMAIL_ADDR.search(original_from)
+            if email_match:
+                return email_match.group(1).lower()
+        
+        in_reply_to = email_msg.get('In-Reply-To', '')
+        if in_reply_to:
+            email_match = _RE_EMAIL_ADDR.search(in_reply_to)
+            if email_match:
+                return email_match.group(1).lower()
+    
+    return None
+
+
+def _remove_invisible_unicode(text):
+    if not text:
+        return ""
+    
+    text = html.unescape(text)
+    
+    text = _RE_SOFT_HYPHEN_JOIN.sub(r'\1 \2', text)
+    text = text.translate(_INVISIBLE_TBL)
+    
+    text = _RE_DOUBLE_SPACE.sub(' ', text)
+    
+    return text
+
+
+def _remove_email_artifacts(text):
+    if not text:
+        return ""
+    
+    text = _strip_mail_headers(text)
+    
+    text = _RE_ON_WROTE_LINE.sub('', text)
+    
+    text = _RE_QUOTED_LINE.sub('', text)
+    
+    text = _RE_STYLE_ATTR.sub(' ', text)
+    
+    text = _RE_MEDIA_RULE.sub(' ', text)
+    text = _RE_AT_RULE.sub(' ', text)
+    
+    text = _RE_CLASS_ATTR.sub(' ', text)
+    text = _RE_ID_ATTR.sub(' ', text)
+    
+    text = _RE_DATA_IMAGE.sub('', text)
+    text = _RE_IMAGE_URL.sub('', text)
+    
+    text = _RE_MIME_BOUNDARY.sub(' ', text)
+    
+    text = _RE_BLANK_LINES.sub('\n\n', text)
+    text = _RE_HSPACE.sub(' ', text)
+    
+    return text.strip()
+
+
+def _html_to_text_bs4(html_content):
+    # Used only when lxml is not installed, hence the stdlib parser.
+    soup = BeautifulSoup(html_content, 'html.parser')
+    
+    for script in soup(["script", "style", "head", "meta", "link"]):
+        script.decompose()
+    
+    for comment in soup.find_all(string=lambda t: isinstance(t, Comment)):
+        comment.extract()
+    
+    text = soup.get_text(separator=' ')
+    
+    return html.unescape(text)
+
+
+def _html_to_text_fallback(html_content):
+    if not html_content:
+        return ""
+    
+    html_content = _RE_HTML_SCRIPT.sub(' ', html_content)
+    
+    html_content = _RE_HTML_STYLE.sub(' ', html_content)
+    
+    html_content = _RE_HTML_HEAD.sub(' ', html_content)
+    
+    html_content = _RE_HTML_COMMENT.sub(' ', html_content)
+    
+    html_content = _RE_HTML_BLOCK_END.sub('\n', html_content)
+    
+    html_content = _RE_HTML_TAG.sub(' ', html_content)
+    
+    text = html.unescape(html_content)
+    
+    return text
+
+
+def _extract_forwarded_content(subject, body):
+    original_subject = subject
+    if subject.lower().startswith('fwd:'):
+        original_subject = subject[4:].strip()
+    elif subject.lower().startswith('fw:'):
+        original_subject = subject[3:].strip()
+    
+    original_body = body
+    
+    header_block = _find_forwarded_header_block(body)
+    
+    if header_block:
+        forwarded_subject, content_after_headers = header_block
+        forwarded_subject = forwarded_subject.strip()
+        
+        if not original_subject or original_subject.lower() in body.lower():
+            original_subject = forwarded_subject
+        
+        original_body = _clean_forwarded_body(content_after_headers)
+    else:
+        forwarding_markers = [
+            '---------- Forwarded message ---------',
+            '---------- Forwarded message ----------',
+            '------- Forwarded message -------',
+            'Begin forwarded message:',
+            'Forwarded by Gmail',
+            '----Original Message----',
+            '-----Original Message-----',
+            '--- Forwarded message ---',
+        ]
+        
+        marker_found = False
+        for marker in forwarding_markers:
+            if marker in body:
+                parts = body.split(marker, 1)
+                if len(parts) > 1:
+                    forwarded_content = parts[1]
+                    
+                    subject_match = _RE_FWD_SUBJECT_LINE.search(forwarded_content)
+                    if subject_match:
+                        start_idx = subject_match.end()
+                        remaining = forwarded_content[start_idx:]
+                        original_body = _clean_forwarded_body(remaining)
+                        marker_found = True
+                        break
+        
+        if not marker_found:
+            original_body = _clean_forwarded_body(body)
+    
+    return original_subject, original_body
+
+
+def _clean_forwarded_body(text):
+    if not text:
+        return ""
+    
+    text = _strip_mail_headers(text, _RE_FWD_MAIL_HEADER)
+    
+    text = _RE_ON_WROTE_LINE.sub('', text)
+    
+    text = _remove_signatures(text)
+    
+    text = _RE_FWD_NOISE_URL.sub('', text)
+    
+    text = _RE_DATA_IMAGE.sub('', text)
+    
+    text = _RE_FWD_VIEW_ONLINE.sub('', text)
+    text = _RE_FWD_UNSUBSCRIBE.sub('', text)
+    text = _RE_FWD_CALL_TO_ACTION.sub('', text)
+    
+    text = _RE_FWD_SUBREDDIT.sub('', text)
+    
+    text = _RE_FWD_NEWSLETTER.sub('', text)
+    text = _RE_FWD_FOLLOW_US.sub('', text)
+    
+    text = _RE_FWD_EQUALS_RUN.sub('', text)
+    text = _RE_FWD_RULE_RUN.sub(' ', text)
+    
+    text = _RE_FWD_SENT_FROM.sub('', text)
+    text = _RE_FWD_GET_OUTLOOK.sub('', text)
+    
+    text = _RE_QUOTED_LINE.sub('', text)
+    
+    text = _RE_BLANK_LINES.sub('\n\n', text)
+    
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    text = '\n'.join(lines)
+    
+    return text.strip()
+
+
+def _remove_signatures(text):
+    text = _RE_SIGNATURE.sub('', text)
+    
+    return text.strip()
+
+
+def _clean_text(text):
+    if not text:
+        return ""
+    
+    text = html.unescape(text)
+    
+    text = _RE_ENTITY.sub(' ', text)
+    
+    # Soft hyphens become spaces here whether or not they sit between
+    # two words, so no separate join pass is needed.
+    text = text.translate(_CLEAN_TBL)
+    
+    # Lowercase only after the table: 'İ' lowers to 'i' plus a combining
+    # dot, which the table would otherwise strip.
+    text = text.lower()
+    
+    text = _RE_CSS_BLOCK.sub(' ', text)
+    text = _RE_CSS_SUP.sub(' ', text)
+    text = _RE_CSS_IMPORTANT.sub(' ', text)
+    text = _RE_CSS_DECL.sub(' ', text)
+    # str.translate is only fast on ASCII; elsewhere the regex wins.
+    if text.isascii():
+        text = text.translate(_GARBAGE_TBL)
+    else:
+        text = _RE_GARBAGE.sub(' ', text)
+
+    text = _RE_SUBREDDIT.sub(' ', text)
+    
+    text = _RE_BOILERPLATE.sub(' ', text)
+    
+    text = _RE_NOISE_URL.sub(' ', text)
+    
+    text = _RE_EMAIL_WORD.sub(' ', text)
+    
+    text = _RE_HEX_TOKEN.sub(' ', text)
+    text = _RE_BASE64_TOKEN.sub(' ', text)
+    
+    text = _RE_SEPARATOR_RUN.sub(' ', text)
+    text = _RE_ELLIPSIS_RUN.sub(' ', text)
+    
+    text = _RE_SENT_FROM_MY.sub(' ', text)
+    text = _RE_ON_WROTE.sub(' ', text)
+    
+    text = _RE_LONG_NUMBER.sub(' ', text)
+    
+    # split() already collapses and trims every whitespace run.
+    words = [w for w in text.split() if len(w) > 1 or w in _MEANINGFUL]
+    text = ' '.join(words)
+    
+    if len(text) < 5:
+        return ""
+    
+    if len(words) < 2:
+        return ""
+    
+    return text
+
+# classify_batch: vectorizer settings _FastTfidf reproduces
+_FAST_TFIDF_PARAMS = {
+    'input': 'content',
+    'analyzer': 'word',
+    'preprocessor': None,
+    'tokenizer': None,
+    'stop_words': None,
+    'strip_accents': None,
+    'binary': False,
+    'use_idf': True,
+    'sublinear_tf': False,
+    'norm': 'l2',
+}
+
+
+class _FastTfidf:
+    """Direct ``TfidfVectorizer.transform`` for word n-gram vectorizers.
+
+    Looks n-grams up in the fitted ``vocabulary_`` and builds the CSR matrix
+    itself, skipping sklearn's per-call validation and analyzer plumbing.
+    Rows are scaled by ``idf_`` and normalised with the same routine sklearn
+    uses, so the output is bit-identical. ``build`` returns None when the
+    vectorizer is configured in a way this class does not reproduce or when
+    its self-check disagrees with sklearn.
+    """
+    
+    def __init__(self, vectorizer):
+        self._token_re = re.compile(vectorizer.token_pattern)
+        self._lowercase = vectorizer.lowercase
+        self._min_n, self._max_n = vectorizer.ngram_range
+        self._vocabulary = vectorizer.vocabulary_
+        self._idf = vectorizer.idf_
+        self._dtype = vectorizer.dtype
+    
+    @classmethod
+    def build(cls, vectorizer):
+        if not isinstance(vectorizer, TfidfVectorizer):
+            return None
+        params = vectorizer.get_params()
+        if any(params[name] != value for name, value in _FAST_TFIDF_PARAMS.items()):
+            return None
+        
+        fast = cls(vectorizer)
+        vocab_sample = ' '.join(term for term, _ in zip(vectorizer.vocabulary_, range(200)))
+        probes = ['', 'a', vocab_sample, vocab_sample.upper() + ' ' + vocab_sample]
+        expected = vectorizer.transform(probes)
+        actual = fast.transform(probes)
+        if (expected.dtype != actual.dtype
+                or not np.array_equal(expected.indptr, actual.indptr)
+                or not np.array_equal(expected.indices, actual.indices)
+                or not np.array_equal(expected.data, actual.data)):
+            return None
+        return fast
+    
+    def _count(self, doc):
+        if self._lowercase:
+            doc = doc.lower()
+        tokens = self._token_re.findall(doc)
+        vocabulary = self._vocabulary
+        counts = Counter()
+        for n in range(self._min_n, self._max_n + 1):
+            if n == 1:
+                grams = tokens
+            else:
+                grams = (' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+            for gram in grams:
+                index = vocabulary.get(gram)
+                if index is not None:
+                    counts[index] += 1
+        return counts
+    
+    def transform(self, docs):
+        indptr = [0]
+        indices = []
+        counts = []
+        for doc in docs:
+            doc_counts = self._count(doc)
+            doc_indices = sorted(doc_counts)
+            indices.extend(doc_indices)
+            counts.extend(doc_counts[i] for i in doc_indices)
+            indptr.append(len(indices))
+        
+        indices = np.asarray(indices, dtype=np.int32)
+        data = np.asarray(counts, dtype=self._dtype) * self._idf[indices]
+        matrix = sp.csr_matrix(
+            (data, indices, np.asarray(indptr, dtype=np.int32)),
+            shape=(len(docs), len(self._idf)),
+        )
+        inplace_csr_row_normalize_l2(matrix)
+        return matrix
+
+# preprocess_email: a bare <local@domain> id, which the header parser would
+# return unchanged
+_ATEXT = r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+"
+_DOT_ATOM = _ATEXT + r"(?:\." + _ATEXT + r")*"
+_RE_PLAIN_MESSAGE_ID = re.compile('<' + _DOT_ATOM + '@' + _DOT_ATOM + '>')
+
+
+def _message_id(msg):
+    """Return the ``Message-Id`` header, or None when it is missing or malformed."""
+    try:
+        # msg.get() builds a structured header object just to read one id;
+        # plain ids are taken straight from the raw header instead.
+        for name, value in msg.raw_items():
+            if name.lower() == 'message-id':
+                if _RE_PLAIN_MESSAGE_ID.fullmatch(value):
+                    return value
+                message_id = msg.get('Message-Id')
+                return str(message_id) if message_id else None
+    except Exception:
+        pass
+    return None
+
+# parsebytes keeps no state between messages, so one parser serves every caller
+_PARSER = BytesParser(policy=policy.default)
+
+
+def parse_email(raw_email):
+    """Parse raw RFC 5322 bytes into the ``EmailMessage`` ``preprocess_email`` takes."""
+    return _PARSER.parsebytes(raw_email)
+
+
+def start_queue_logging(level=logging.INFO):
+    """Send log records through a queue drained by a background thread.
+
+    Handlers then never write to the console on the SMTP event loop. Returns
+    the started ``QueueListener``; stop it at shutdown to flush what is left.
+    """
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(
+        "%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        datefmt="%H:%M:%S",
+    ))
+    listener = logging.handlers.QueueListener(log_queue, console, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    # aiosmtpd logs every SMTP command at INFO; keep it to warnings and errors.
+    logging.getLogger("mail.log").setLevel(logging.WARNING)
+    listener.start()
+    return listener
+
+# Match flags stored under the None key of whitelist trie nodes
+_WL_EXACT = 1
+_WL_SUBDOMAINS = 2
+
 class PhishingDetector:
     
     def __init__(self, host='localhost', port=1025, model_dir=None, whitelist_domains=None):
@@ -23,11 +707,28 @@ class PhishingDetector:
         self.model_path = model_dir / 'phishing_model_b.joblib'
         self.vectorizer_path = model_dir / 'tfidf_vectorizer_b.joblib'
         
-        print(f"Loading model from: {self.model_path}")
-        print(f"Loading vectorizer from: {self.vectorizer_path}")
-        self.model = joblib.load(self.model_path)
+        logger.info("Loading model from: %s", self.model_path)
+        logger.info("Loading vectorizer from: %s", self.vectorizer_path)
+        # The model is dumped uncompressed, so its coefficient arrays are
+        # memory-mapped read-only and shared between processes.
+        self.model = joblib.load(self.model_path, mmap_mode='r')
         self.vectorizer = joblib.load(self.vectorizer_path)
-        print("Model and vectorizer loaded successfully!")
+        logger.info("Model and vectorizer loaded successfully")
+        
+        # None when the vectorizer has to go through sklearn's transform
+        self._fast_tfidf = _FastTfidf.build(self.vectorizer)
+        if self._fast_tfidf is None:
+            logger.info("Using sklearn TF-IDF transform")
+        self._warm_up()
+        
+        # LRU of recent (subject, body) -> classification, keyed by a blake2b digest
+        self._pred_cache = OrderedDict()
+        # classify_batch runs on the inference pool, so cache access is locked
+        self._pred_cache_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix='inference')
+        # Created lazily on the SMTP controller's event loop
+        self._infer_queue = None
+        self._batcher_task = None
         
         if whitelist_domains is None:
             self.whitelist_domains = {
@@ -46,54 +747,57 @@ class PhishingDetector:
                 'instagram.com',
             }
         else:
-            self.whitelist_domains = set(whitelist_domains)
+            self.whitelist_domains = whitelist_domains
         
-        print(f"Whitelisted domains: {len(self.whitelist_domains)} trusted senders")
+        logger.info("Whitelisted domains: %d trusted senders", len(self.whitelist_domains))
         
         self.smtp_controller = None
     
     async def handle_DATA(self, server, session, envelope):
-        print(f"\n{'='*60}")
-        print(f"Received email from: {envelope.mail_from}")
-        print(f"Recipients: {envelope.rcpt_tos}")
-        print(f"{'='*60}")
+        logger.info("Received email from: %s, recipients: %s", envelope.mail_from, envelope.rcpt_tos)
         
         try:
-            email_content = envelope.content
+            sender = envelope.mail_from
+            
+            # A whitelisted envelope sender is legitimate whatever the body
+            # says, so skip body extraction and cleaning altogether.
+            if self.is_whitelisted(sender):
+                logger.info("Domain whitelisted (%s) - skipping model", sender)
+                self._log_result(sender, None, {
+                    'label': 'legitimate',
+                    'probability': 1.0,
+                    'reason': 'whitelisted_domain'
+                })
+                return '250 Message accepted for delivery'
             
-            extracted_data = self.preprocess_email(email_content)
+            msg = parse_email(envelope.content)
+            
+            extracted_data = self.preprocess_email(msg)
             
             if extracted_data:
-                sender = envelope.mail_from
                 subject = extracted_data['subject']
                 body = extracted_data['body']
                 original_sender = extracted_data.get('original_sender')
                 
-                print(f"\n[PREPROCESSING RESULTS]")
-                print(f"Original Subject: {extracted_data['original_subject'][:100]}")
-                print(f"Cleaned Subject: {subject[:100]}")
-                print(f"\nOriginal Body (first 300 chars):")
-                print(f"{extracted_data['original_body'][:300]}")
-                print(f"\nCleaned Body (first 300 chars):")
-                print(f"{body[:300]}")
-                print(f"\nBody length: {len(body)} characters")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "Preprocessing results\n"
+                        "Original Subject: %s\nCleaned Subject: %s\n"
+                        "Original Body (first 300 chars):\n%s\n"
+                        "Cleaned Body (first 300 chars):\n%s\n"
+                        "Body length: %d characters",
+                        extracted_data['original_subject'][:100], subject[:100],
+                        extracted_data['original_body'][:300], body[:300], len(body),
+                    )
                 
                 if original_sender:
-                    print(f"\n[ORIGINAL SENDER DETECTED]")
-                    print(f"Original sender: {original_sender}")
+                    logger.info("Original sender detected: %s", original_sender)
                 
                 if len(body) < 20:
-                    print(f"\nΓÜá WARNING: Body too short after cleaning - may indicate preprocessing issue")
-
-                whitelisted_address = None
-                if self.is_whitelisted(sender):
-                    whitelisted_address = sender
-                elif original_sender and self.is_whitelisted(original_sender):
-                    whitelisted_address = original_sender
+                    logger.warning("Body too short after cleaning - may indicate preprocessing issue")
 
-                if whitelisted_address:
-                    print(f"\n[WHITELIST CHECK]")
-                    print(f"✔ Domain whitelisted ({whitelisted_address}) - skipping model")
+                if original_sender and self.is_whitelisted(original_sender):
+                    logger.info("Domain whitelisted (%s) - skipping model", original_sender)
                     result = {
                         'label': 'legitimate',
                         'probability': 1.0,
@@ -101,32 +805,28 @@ class PhishingDetector:
                     }
                 else:
                     if original_sender:
-                        print(f"\n[WHITELIST CHECK]")
-                        print(f"✘ Domain not whitelisted - running model")
+                        logger.info("Domain not whitelisted - running model")
                     
-                    result = self.classify_email(subject, body)
+                    result = await self.classify_email_async(subject, body)
                     result['reason'] = 'model_prediction'
                 
-                print(f"\n{'='*60}")
-                print(f"CLASSIFICATION RESULT:")
-                print(f"  Sender: {sender}")
-                if original_sender:
-                    print(f"  Original Sender: {original_sender}")
-                print(f"  Label: {result['label'].upper()}")
-                print(f"  Probability: {result['probability']:.2%}")
-                print(f"  Reason: {result['reason']}")
-                print(f"{'='*60}\n")
+                self._log_result(sender, original_sender, result)
                 
             else:
-                print("Failed to extract email content")
+                logger.warning("Failed to extract email content")
                 
-        except Exception as e:
-            print(f"Error processing email: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error processing email")
         
         return '250 Message accepted for delivery'
     
+    def _log_result(self, sender, original_sender, result):
+        logger.info(
+            "Classification result: %s %.2f%% via %s (sender: %s, original sender: %s)",
+            result['label'].upper(), result['probability'] * 100, result['reason'],
+            sender, original_sender or '-',
+        )
+    
     def start_server(self):
         handler = SMTPHandler(self)
         self.smtp_controller = Controller(
@@ -139,114 +839,151 @@ class PhishingDetector:
         print(f"Waiting for emails... (Press Ctrl+C to stop)\n")
     
     def stop_server(self):
+        self._stop_batcher()
         if self.smtp_controller:
             self.smtp_controller.stop()
             print("SMTP Server stopped")
+        self._pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _stop_batcher(self):
+        """Cancel the micro-batcher and fail the emails still waiting for it."""
+        task = self._batcher_task
+        if task is None:
+            return
+        loop = task.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            loop.create_task(self._drain_batcher())
+        elif loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(self._drain_batcher(), loop).result(timeout=5)
+            except Exception as e:
+                logger.warning("Failed to stop the inference batcher: %s", e)
+    
+    async def _drain_batcher(self):
+        task, queue = self._batcher_task, self._infer_queue
+        self._batcher_task = self._infer_queue = None
+        if task is None:
+            return
+        task.cancel()
+        error = RuntimeError("Detector stopped")
+        while not queue.empty():
+            _, _, future = queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
     
     def get_original_sender(self, raw_body, email_msg=None):
-        patterns = [
-            r'from[:\s]+<?([a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})>?',
-            r'forwarded\s+(?:message\s+)?from[:\s]+<?([a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})>?',
-            r'originally\s+sent\s+by[:\s]+<?([a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})>?',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, raw_body, re.IGNORECASE)
-            if match:
-                return match.group(1).lower()
-        
-        if email_msg:
-            original_from = email_msg.get('X-Original-From', '')
-            if original_from:
-                email_match = re.search(r'([a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})', original_from, re.IGNORECASE)
-                if email_match:
-                    return email_match.group(1).lower()
-            
-            in_reply_to = email_msg.get('In-Reply-To', '')
-            if in_reply_to:
-                email_match = re.search(r'([a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})', in_reply_to, re.IGNORECASE)
-                if email_match:
-                    return email_match.group(1).lower()
-        
-        return None
+        return get_original_sender(raw_body, email_msg)
+    
+    @property
+    def whitelist_domains(self):
+        return self._whitelist_domains
+    
+    @whitelist_domains.setter
+    def whitelist_domains(self, domains):
+        self._whitelist_domains = frozenset(domains)
+        self._whitelist_trie = self._build_whitelist_trie(self._whitelist_domains)
+        # Per-instance cache, rebuilt whenever the whitelist is replaced
+        self._whitelist_lookup = functools.lru_cache(maxsize=4096)(self._check_whitelist)
+    
+    @staticmethod
+    def _build_whitelist_trie(domains):
+        """Index ``domains`` by reversed label (``com`` -> ``google`` -> ...).
+
+        The ``None`` key of a node holds match flags: ``_WL_EXACT`` matches
+        the domain itself, ``_WL_SUBDOMAINS`` any domain below it. Two-label
+        entries such as ``google.com`` set both, ``*.corp.example.com`` sets
+        only ``_WL_SUBDOMAINS`` and any other entry only ``_WL_EXACT``.
+        """
+        trie = {}
+        for domain in domains:
+            if domain.startswith('*.'):
+                labels = domain[2:].split('.')
+                flags = _WL_SUBDOMAINS
+            else:
+                labels = domain.split('.')
+                flags = _WL_EXACT | _WL_SUBDOMAINS if len(labels) == 2 else _WL_EXACT
+            node = trie
+            for label in reversed(labels):
+                node = node.setdefault(label, {})
+            node[None] = node.get(None, 0) | flags
+        return trie
+    
+    def _check_whitelist(self, email_address):
+        domain = email_address.rpartition('@')[2].lower()
+        if domain in self._whitelist_domains:
+            return True
+        labels = domain.split('.')
+        node = self._whitelist_trie
+        for remaining in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[remaining])
+            if node is None:
+                return False
+            flags = node.get(None, 0)
+            if remaining and flags & _WL_SUBDOMAINS:
+                return True
+        return bool(flags & _WL_EXACT)
     
     def is_whitelisted(self, email_address):
         if not email_address or '@' not in email_address:
             return False
-        
-        domain = email_address.split('@')[-1].lower()
-        
-        if domain in self.whitelist_domains:
-            return True
-        
-        parts = domain.split('.')
-        if len(parts) > 2:
-            parent_domain = '.'.join(parts[-2:])
-            if parent_domain in self.whitelist_domains:
-                return True
-        
-        return False
+        return self._whitelist_lookup(email_address)
     
-    def preprocess_email(self, raw_email):
+    def check_trust(self, user_id, address, domain, user_trusts_domain=None):
+        """Return ``address`` if it is whitelisted or ``domain`` is trusted by ``user_id``, else None.
+
+        The global whitelist is checked first; ``user_trusts_domain(user_id, domain)``
+        answers the per-user part and is only called when the whitelist misses.
+        """
+        if self.is_whitelisted(address):
+            return address
+        if user_trusts_domain is not None and user_trusts_domain(user_id, domain):
+            return address
+        return None
+    
+    def preprocess_email(self, msg):
+        """Extract and clean subject/body from an already parsed ``EmailMessage``."""
         try:
-            if isinstance(raw_email, bytes):
-                msg = message_from_bytes(raw_email, policy=policy.default)
-            else:
-                msg = message_from_bytes(raw_email.encode(), policy=policy.default)
-            
             subject = msg.get('subject', '')
+            if len(subject) > MAX_SUBJECT_CHARS:
+                logger.debug("Subject truncated from %d to %d characters", len(subject), MAX_SUBJECT_CHARS)
+                subject = subject[:MAX_SUBJECT_CHARS]
             
             body = self._extract_body(msg)
-            body = body[:50_000] if body and len(body) > 50_000 else body
-            body = self._remove_invisible_unicode(body)
+            if body and len(body) > MAX_BODY_CHARS:
+                logger.debug("Body truncated from %d to %d characters", len(body), MAX_BODY_CHARS)
+                body = body[:MAX_BODY_CHARS]
+            body = _remove_invisible_unicode(body)
             
-            original_sender = self.get_original_sender(body, msg)
+            original_sender = get_original_sender(body, msg)
             
-            original_subject, original_body = self._extract_forwarded_content(subject, body)
+            original_subject, original_body = _extract_forwarded_content(subject, body)
             
-            cleaned_subject = self._clean_text(original_subject)
-            cleaned_body = self._clean_text(original_body)
+            cleaned_subject = _clean_text(original_subject)
+            cleaned_body = _clean_text(original_body)
             
             return {
                 'subject': cleaned_subject,
                 'body': cleaned_body,
                 'original_subject': subject,
                 'original_body': body,
-                'original_sender': original_sender
+                'original_sender': original_sender,
+                'message_id': _message_id(msg),
             }
             
         except Exception as e:
-            print(f"Error parsing email: {e}")
+            logger.warning("Error parsing email: %s", e)
             return None
     
     def _remove_invisible_unicode(self, text):
-        if not text:
-            return ""
-        
-        text = html.unescape(text)
-        
-        text = re.sub(r'(\S)\u00AD(\S)', r'\1 \2', text)
-        text = text.replace('\u00AD', '')
-        
-        text = text.replace('\u200B', ' ')
-        text = text.replace('\u200C', ' ')
-        text = text.replace('\u200D', ' ')
-        text = text.replace('\uFEFF', ' ')
-        
-        text = re.sub(r'[\u200e\u200f\u202a-\u202e\u2060\u180e\u061c]', ' ', text)
-        
-        text = text.replace('\u00A0', ' ')
-        text = text.replace('\u2002', ' ')
-        text = text.replace('\u2003', ' ')
-        text = text.replace('\u2009', ' ')
-        text = text.replace('\u200A', ' ')
-        text = text.replace('\u202F', ' ')
-        
-        text = re.sub(r'[\u0300-\u036f\u0483-\u0489\u034f\u115f\u1160]', '', text)
-        
-        text = re.sub(r'  +', ' ', text)
-        
-        return text
+        return _remove_invisible_unicode(text)
     
     def _extract_body(self, msg):
         body = ""
@@ -296,277 +1033,156 @@ class PhishingDetector:
         if not body and html_body:
             body = self._html_to_text(html_body)
         
-        body = self._remove_email_artifacts(body)
+        body = _remove_email_artifacts(body)
         
         return body if body else ""
     
     def _remove_email_artifacts(self, text):
-        if not text:
-            return ""
-        
-        text = re.sub(r'^\s*(?:To|From|Date|Sent|Cc|Bcc|Subject|Reply-To):\s*.+?$', '', text, flags=re.MULTILINE | re.IGNORECASE)
-        
-        text = re.sub(r'^On\s+.+?wrote:\s*$', '', text, flags=re.MULTILINE | re.IGNORECASE)
-        
-        text = re.sub(r'^[>|]\s*.+?$', '', text, flags=re.MULTILINE)
-        
-        text = re.sub(r'style\s*=\s*["\'][^"\']{0,200}["\']', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'@media[^{]*\{[^}]*\}', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'@[a-z-]+\s+[^{]*\{[^}]*\}', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'class\s*=\s*["\'][^"\']+["\']', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'id\s*=\s*["\'][^"\']+["\']', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'data:image/[^;]+;base64,[^\s]+', '', text)
-        text = re.sub(r'https?://[^\s]*\.(?:png|jpg|gif|jpeg)\?[^\s]*', '', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'--\s*\w+\s*(?:boundary|delimiter)\s*--', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'\n{3,}', '\n\n', text)
-        text = re.sub(r'[ \t]+', ' ', text)
-        
-        return text.strip()
+        return _remove_email_artifacts(text)
     
     def _html_to_text(self, html_content):
         if not html_content:
             return ""
         
         try:
-            soup = BeautifulSoup(html_content, 'lxml')
-            
-            for script in soup(["script", "style", "head", "meta", "link"]):
-                script.decompose()
-            
-            for comment in soup.find_all(string=lambda t: isinstance(t, Comment)):
-                comment.extract()
-            
-            text = soup.get_text(separator=' ')
-            
-            text = html.unescape(text)
-            
-            return text
+            if etree is not None:
+                parser = etree.HTMLParser(target=_HTMLTextCollector(), recover=True)
+                parser.feed(html_content)
+                # Entities are already decoded by the parser.
+                return parser.close()
+            if BeautifulSoup is not None:
+                return _html_to_text_bs4(html_content)
             
         except Exception as e:
-            print(f"Warning: BeautifulSoup parsing failed, using regex fallback: {e}")
-            return self._html_to_text_fallback(html_content)
+            logger.warning("HTML parsing failed, using regex fallback: %s", e)
+        return _html_to_text_fallback(html_content)
     
     def _html_to_text_fallback(self, html_content):
-        if not html_content:
-            return ""
-        
-        html_content = re.sub(r'<script[^>]*>.*?</script>', ' ', html_content, flags=re.DOTALL | re.IGNORECASE)
-        
-        html_content = re.sub(r'<style[^>]*>.*?</style>', ' ', html_content, flags=re.DOTALL | re.IGNORECASE)
-        
-        html_content = re.sub(r'<head[^>]*>.*?</head>', ' ', html_content, flags=re.DOTALL | re.IGNORECASE)
-        
-        html_content = re.sub(r'<!--.*?-->', ' ', html_content, flags=re.DOTALL)
-        
-        html_content = re.sub(r'</(div|p|br|tr|h[1-6]|li)[^>]*>', '\n', html_content, flags=re.IGNORECASE)
-        
-        html_content = re.sub(r'<[^>]+>', ' ', html_content)
-        
-        text = html.unescape(html_content)
-        
-        return text
+        return _html_to_text_fallback(html_content)
     
     def _extract_forwarded_content(self, subject, body):
-        original_subject = subject
-        if subject.lower().startswith('fwd:'):
-            original_subject = subject[4:].strip()
-        elif subject.lower().startswith('fw:'):
-            original_subject = subject[3:].strip()
-        
-        original_body = body
-        
-        header_pattern = r'(?:From|FROM):\s*.+?(?:\n|\r\n)(?:.*?\n)*?(?:Subject|SUBJECT):\s*(.+?)(?:\n|\r\n)(.+)'
-        match = re.search(header_pattern, body, re.DOTALL | re.IGNORECASE)
-        
-        if match:
-            forwarded_subject = match.group(1).strip()
-            content_after_headers = match.group(2)
-            
-            if not original_subject or original_subject.lower() in body.lower():
-                original_subject = forwarded_subject
-            
-            original_body = self._clean_forwarded_body(content_after_headers)
-        else:
-            forwarding_markers = [
-                '---------- Forwarded message ---------',
-                '---------- Forwarded message ----------',
-                '------- Forwarded message -------',
-                'Begin forwarded message:',
-                'Forwarded by Gmail',
-                '----Original Message----',
-                '-----Original Message-----',
-                '--- Forwarded message ---',
-            ]
-            
-            marker_found = False
-            for marker in forwarding_markers:
-                if marker in body:
-                    parts = body.split(marker, 1)
-                    if len(parts) > 1:
-                        forwarded_content = parts[1]
-                        
-                        subject_match = re.search(r'\n\s*Subject:\s*(.+?)(?:\n|$)', forwarded_content, re.IGNORECASE)
-                        if subject_match:
-                            start_idx = subject_match.end()
-                            remaining = forwarded_content[start_idx:]
-                            original_body = self._clean_forwarded_body(remaining)
-                            marker_found = True
-                            break
-            
-            if not marker_found:
-                original_body = self._clean_forwarded_body(body)
-        
-        return original_subject, original_body
+        return _extract_forwarded_content(subject, body)
     
     def _clean_forwarded_body(self, text):
-        if not text:
-            return ""
-        
-        text = re.sub(r'^\s*(To|From|Date|Sent|Cc|Bcc|Subject|Reply-To|Delivered-To|Return-Path):\s*.+?$', '', text, flags=re.MULTILINE | re.IGNORECASE)
-        
-        text = re.sub(r'^On\s+.+?wrote:\s*$', '', text, flags=re.MULTILINE | re.IGNORECASE)
-        
-        text = self._remove_signatures(text)
-        
-        text = re.sub(r'https?://[^\s]+\.(?:png|jpg|gif|jpeg|svg)\?[^\s]*', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'https?://[^\s]*(?:track|click|pixel|beacon|analytics|utm_)[^\s]*', '', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'data:image/[^;]+;base64,[^\s]+', '', text)
-        
-        text = re.sub(r'(?:view|read|open).{0,30}(?:browser|web|online)', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'(?:unsubscribe|manage\s+preferences|update\s+settings)', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'(?:click\s+here|tap\s+here|learn\s+more)', '', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'r/[a-z0-9_]+:', '', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'subscribe\s+to\s+our\s+newsletter', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'follow\s+us\s+on', '', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'={3,}', '', text)
-        text = re.sub(r'[-_]{5,}', ' ', text)
-        
-        text = re.sub(r'^\s*Sent from my .+$', '', text, flags=re.MULTILINE | re.IGNORECASE)
-        text = re.sub(r'^\s*Get Outlook for .+$', '', text, flags=re.MULTILINE | re.IGNORECASE)
-        
-        text = re.sub(r'^[>|]\s*.+?$', '', text, flags=re.MULTILINE)
-        
-        text = re.sub(r'\n{3,}', '\n\n', text)
-        
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
-        text = '\n'.join(lines)
-        
-        return text.strip()
+        return _clean_forwarded_body(text)
     
     def _remove_signatures(self, text):
-        signature_patterns = [
-            r'\n--\s*\n.*$',
-            r'\n_{10,}.*$',
-            r'\n={10,}.*$',
-            r'\nBest regards.*$',
-            r'\nThanks.*$',
-            r'\nSent from.*$',
-        ]
-        
-        for pattern in signature_patterns:
-            text = re.sub(pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
-        
-        return text.strip()
+        return _remove_signatures(text)
     
     def _clean_text(self, text):
-        if not text:
-            return ""
-        
-        text = html.unescape(text)
-        
-        text = re.sub(r'&[a-z]+;', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'&#\d+;', ' ', text)
-        text = re.sub(r'&#x[0-9a-f]+;', ' ', text, flags=re.IGNORECASE)
-        
-        text = text.replace('\u200B', ' ')
-        text = text.replace('\u200C', ' ')
-        text = text.replace('\u200D', ' ')
-        text = re.sub(r'[\u200e\u200f\u202a-\u202e\u2060\uFEFF\u180e\u061c]', ' ', text)
-        
-        text = re.sub(r'(\S)\u00AD(\S)', r'\1 \2', text)
-        text = text.replace('\u00AD', ' ')
-        
-        text = text.replace('\u00A0', ' ')
-        text = re.sub(r'[\u2002\u2003\u2009\u200A\u202F]', ' ', text)
-        
-        text = re.sub(r'[\u0300-\u036f\u0483-\u0489\u0591-\u05bd\u05bf\u05c1\u05c2\u05c4\u05c5\u05c7]', '', text)
-        text = re.sub(r'[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06dc\u06df-\u06e4\u06e7\u06e8]', '', text)
-        text = re.sub(r'[\u06ea-\u06ed\u0711\u0730-\u074a\u07a6-\u07b0\u07eb-\u07f3]', '', text)
-        
-        text = re.sub(r'[\u034f\u115f\u1160\u17b4\u17b5\u180b-\u180d]', '', text)
-        
-        text = re.sub(r'\w+\s*\{[^}]+\}', ' ', text)
-        text = re.sub(r'sup\s*\{[^}]+\}', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'[a-z-]+\s*:\s*[^;{}\n]+\s*!important\s*;?', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'[a-z-]+\s*:\s*[^;{}\n]+;', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'[{}!;%@#~^*]', ' ', text)
-
-        text = re.sub(r'\br/[a-z0-9_]+\b\s*:?\s*', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'(?:view|read|open)\s+(?:this\s+)?(?:email|message|newsletter)\s+(?:in|on)\s+(?:your\s+)?(?:browser|web)', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'(?:unsubscribe|manage\s+preferences|update\s+email|update\s+settings)', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'https?://[^\s]+\?[^\s]+', ' ', text)
-        text = re.sub(r'https?://[^\s]*(?:track|pixel|beacon|analytics|click)[^\s]*', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'\b[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,}\b', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'\b[a-f0-9]{32,}\b', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'\b[A-Za-z0-9+/]{40,}={0,2}\b', ' ', text)
-        
-        text = re.sub(r'[_=\-|\\\/]{3,}', ' ', text)
-        text = re.sub(r'\.{3,}', ' ', text)
-        
-        text = re.sub(r'sent\s+from\s+my\s+\w+', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'on\s+.+?wrote:', ' ', text, flags=re.IGNORECASE)
-        
-        text = re.sub(r'\b\d{10,}\b', ' ', text)
-        
-        text = text.lower()
-        
-        text = re.sub(r'\s+', ' ', text)
-        
-        text = text.strip()
-        
-        words = text.split()
-        meaningful_chars = {'i', 'a'}
-        words = [w for w in words if len(w) > 1 or w in meaningful_chars]
-        text = ' '.join(words)
-        
-        if len(text) < 5:
-            return ""
-        
-        words = text.split()
-        if len(words) < 2:
-            return ""
-        
-        return text
+        return _clean_text(text)
+    
+    def _warm_up(self):
+        """Fault in model pages and sklearn's lazy state before the first email."""
+        try:
+            features = self.vectorizer.transform(['warmup text goes here'])
+            self.model.predict(features)
+            self.model.predict_proba(features)
+        except Exception as e:
+            logger.warning("Model warm-up failed: %s", e)
     
     def classify_email(self, subject, body):
-        text = f"{subject} {body}"
-        
-        features = self.vectorizer.transform([text])
+        return self.classify_batch([(subject, body)])[0]
+    
+    def classify_batch(self, emails):
+        """Classify ``(subject, body)`` pairs with one transform/predict call."""
+        results = [None] * len(emails)
+        misses = []
+        keys = [
+            hashlib.blake2b(
+                f"{subject}\x00{body}".encode('utf-8', 'surrogatepass'), digest_size=16
+            ).digest()
+            for subject, body in emails
+        ]
+        with self._pred_cache_lock:
+            for i, (key, (subject, body)) in enumerate(zip(keys, emails)):
+                cached = self._pred_cache.get(key)
+                if cached is not None:
+                    self._pred_cache.move_to_end(key)
+                    results[i] = dict(cached)
+                else:
+                    misses.append((i, key, f"{subject} {body}"))
         
-        prediction = self.model.predict(features)[0]
-        prediction_proba = self.model.predict_proba(features)[0]
+        if misses:
+            texts = [text for _, _, text in misses]
+            if self._fast_tfidf is not None:
+                features = self._fast_tfidf.transform(texts)
+            else:
+                features = self.vectorizer.transform(texts)
+            
+            predictions = self.model.predict(features)
+            prediction_probas = self.model.predict_proba(features)
+            
+            with self._pred_cache_lock:
+                for (i, key, _), prediction, prediction_proba in zip(misses, predictions, prediction_probas):
+                    result = {
+                        'label': 'phishing' if prediction == 1 else 'legitimate',
+                        'probability': float(prediction_proba[prediction])
+                    }
+                    self._pred_cache[key] = result
+                    if len(self._pred_cache) > PREDICTION_CACHE_SIZE:
+                        self._pred_cache.popitem(last=False)
+                    # Callers annotate the result dict, so never hand out the cached one
+                    results[i] = dict(result)
         
-        probability = prediction_proba[prediction]
+        return results
+    
+    async def classify_email_async(self, subject, body):
+        """Queue one email for the micro-batcher and wait for its result."""
+        loop = asyncio.get_running_loop()
+        if self._infer_queue is None:
+            self._infer_queue = asyncio.Queue()
+            self._batcher_task = loop.create_task(self._run_batcher())
+        
+        future = loop.create_future()
+        await self._infer_queue.put((subject, body, future))
+        return await future
+    
+    async def _run_batcher(self):
+        queue = self._infer_queue
+        loop = asyncio.get_running_loop()
+        # One batch in flight per pool worker; the rest wait in the queue
+        # and are picked up together once a worker frees up.
+        free_workers = asyncio.Semaphore(INFERENCE_WORKERS)
+        batch = []
+        try:
+            while True:
+                batch = [await queue.get()]
+                await free_workers.acquire()
+                # Only take what is already waiting; a lone email is never delayed.
+                while len(batch) < INFERENCE_BATCH_SIZE and not queue.empty():
+                    batch.append(queue.get_nowait())
+                
+                done = loop.run_in_executor(
+                    self._pool, self.classify_batch, [(subject, body) for subject, body, _ in batch]
+                )
+                done.add_done_callback(functools.partial(self._resolve_batch, batch, free_workers))
+                batch = []
+        except asyncio.CancelledError:
+            # Taken from the queue but not yet handed to the pool
+            error = RuntimeError("Detector stopped")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+    
+    @staticmethod
+    def _resolve_batch(batch, free_workers, done):
+        free_workers.release()
+        if done.cancelled():
+            error = asyncio.CancelledError()
+        else:
+            error = done.exception()
         
-        label = 'phishing' if prediction == 1 else 'legitimate'
+        if error is not None:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
         
-        return {
-            'label': label,
-            'probability': float(probability)
-        }
+        for (_, _, future), result in zip(batch, done.result()):
+            if not future.done():
+                future.set_result(result)
 
 class SMTPHandler:
     
@@ -585,9 +1201,12 @@ def main():
     parser.add_argument('--model-dir', default=None, help='Directory containing model files')
     parser.add_argument('--whitelist', nargs='*', help='Additional domains to whitelist (e.g., mycompany.com)')
     parser.add_argument('--no-whitelist', action='store_true', help='Disable domain whitelisting')
+    parser.add_argument('--verbose', action='store_true', help='Log preprocessing details for every email')
     
     args = parser.parse_args()
     
+    log_listener = start_queue_logging(logging.DEBUG if args.verbose else logging.INFO)
+    
     try:
         whitelist_domains = None
         if args.no_whitelist:
@@ -622,6 +1241,8 @@ def main():
         print(f"Error: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        log_listener.stop()
 
 if __name__ == '__main__':
     main()
@@ -3,25 +3,40 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import functools
 import hashlib
+import logging
+import queue
 import re
+import signal
 import smtplib
-import traceback
-from email import policy
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
-from email.parser import BytesParser
 from email.utils import formatdate
 from pathlib import Path
 from typing import Optional
 
 from aiosmtpd.controller import Controller
 
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
+
 from database import DatabaseManager
-from phishing_detector import PhishingDetector
+from phishing_detector import PhishingDetector, parse_email, start_queue_logging
+
+logger = logging.getLogger(__name__)
 
 DB_MANAGER: Optional[DatabaseManager] = None
 DETECTOR: Optional[PhishingDetector] = None
 MODEL_VERSION: str = "unknown"
+# Runs handle_smtp_email off the event loop; None falls back to the loop's default executor.
+EXECUTOR: Optional[ThreadPoolExecutor] = None
+HANDLER_WORKERS = 8
 
 REPLY_CFG: dict = {
     "enabled": False,
@@ -30,20 +45,69 @@ REPLY_CFG: dict = {
     "from_addr": "phishing-scanner@localhost",
 }
 
+# Each router caches every user's trusted domains, loaded on their first
+# message. Edits made through the router's DatabaseManager drop the entry at
+# once; the web API edits from another process, so entries also expire after
+# TRUSTED_CACHE_TTL.
+TRUSTED_CACHE_TTL = 30.0
+
+# Event and prediction rows are buffered and written by a background thread,
+# LOG_BATCH_SIZE rows at a time or LOG_FLUSH_SECS after the first one waits.
+# Rows that fail to write go back to the front of the buffer and are retried
+# with backoff; a row is dropped after LOG_MAX_ATTEMPTS failed writes.
+LOG_BATCH_SIZE = 64
+LOG_FLUSH_SECS = 0.05
+LOG_MAX_ATTEMPTS = 5
+LOG_RETRY_SECS = 0.5
+LOG_RETRY_MAX_SECS = 30.0
+# (database, event row, prediction row, failed write attempts so far)
+_LOG_ROWS: list[tuple[DatabaseManager, dict, dict, int]] = []
+_LOG_COND = threading.Condition()
+_LOG_FLUSH_LOCK = threading.Lock()
+_LOG_THREAD: Optional[threading.Thread] = None
+_LOG_STOPPING = False
+
+# Replies are sent by one background thread over a connection it keeps open;
+# None on the queue stops it.
+_REPLY_QUEUE: "queue.SimpleQueue[Optional[tuple[str, bytes]]]" = queue.SimpleQueue()
+_REPLY_THREAD: Optional[threading.Thread] = None
+_REPLY_THREAD_LOCK = threading.Lock()
+# Relay addresses from getaddrinfo, reused on reconnect; only the reply
+# thread touches this.
+RELAY_DNS_TTL = 300.0
+_RELAY_ADDRS: dict[tuple[str, int], tuple[float, list[str]]] = {}
+
+_ASCII_WS = b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+
+# Keyed by the raw address: mail is mostly from a small set of repeat senders.
+@functools.lru_cache(maxsize=4096)
+def _hash_email_cached(email: str) -> str:
+    if email.isascii():
+        # Same result as the str path below: _ASCII_WS is exactly what str.strip()
+        # removes from ASCII text, and bytes.lower() matches str.lower() there.
+        normalized = email.encode("ascii").strip(_ASCII_WS).lower()
+    else:
+        normalized = email.strip().lower().encode("utf-8")
+    if not normalized:
+        return ""
+    return hashlib.sha256(normalized).hexdigest()
+
 
 def hash_email(email: Optional[str]) -> str:
     if not email:
         return ""
-    normalized = email.strip().lower()
-    if not normalized:
-        return ""
-    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+    return _hash_email_cached(email)
+
+
+@functools.lru_cache(maxsize=4096)
+def _sender_domain_cached(sender_email: str) -> str:
+    return sender_email[sender_email.rfind("@") + 1:].lower()
 
 
 def get_sender_domain(sender_email: Optional[str]) -> str:
     if not sender_email or "@" not in sender_email:
         return ""
-    return sender_email.split("@")[-1].lower()
+    return _sender_domain_cached(sender_email)
 
 
 def _phishing_risk_level(probability: float) -> str:
@@ -54,11 +118,15 @@ def _phishing_risk_level(probability: float) -> str:
     return "LOW"
 
 
-def _message_id_hash(raw_message: bytes) -> Optional[str]:
+def _finalize_prediction(label: str, probability: float) -> tuple[float, str]:
+    """Turn the model's confidence in ``label`` into (phishing probability, risk level)."""
+    if label == "legitimate":
+        probability = 1.0 - probability
+    return probability, _phishing_risk_level(probability)
+
+
+def _message_id_hash(message_id: Optional[str]) -> Optional[str]:
     try:
-        parser = BytesParser(policy=policy.default)
-        msg = parser.parsebytes(raw_message)
-        message_id = msg.get("Message-Id")
         if message_id:
             return hashlib.sha256(message_id.encode("utf-8")).hexdigest()
     except Exception:
@@ -66,6 +134,130 @@ def _message_id_hash(raw_message: bytes) -> Optional[str]:
     return None
 
 
+def _queue_db_log(db: DatabaseManager, event_row: dict, prediction_row: dict) -> None:
+    _start_log_flusher()
+    with _LOG_COND:
+        _LOG_ROWS.append((db, event_row, prediction_row, 0))
+        if len(_LOG_ROWS) == 1 or len(_LOG_ROWS) >= LOG_BATCH_SIZE:
+            _LOG_COND.notify()
+
+
+def _write_log_rows(rows: list[tuple[DatabaseManager, dict, dict, int]]) -> None:
+    # All rows share one database. One transaction, so a failed write stores
+    # nothing and is safe to retry. Duplicate Message-Id hashes resolve to the
+    # stored event, whose existing prediction is then kept.
+    rows[0][0].log_scans_bulk([(event_row, prediction_row) for _, event_row, prediction_row, _ in rows])
+
+
+def flush_db_log() -> None:
+    """Write every buffered email event and its prediction now.
+
+    If the batch fails, each row is retried on its own so one bad row cannot
+    drop the others. Rows that still fail are put back in the buffer and the
+    last error is raised.
+    """
+    with _LOG_FLUSH_LOCK:
+        with _LOG_COND:
+            rows = list(_LOG_ROWS)
+            _LOG_ROWS.clear()
+        if not rows:
+            return
+        # Routers bound to different databases share this buffer.
+        batches: dict[DatabaseManager, list] = {}
+        for row in rows:
+            batches.setdefault(row[0], []).append(row)
+
+        failed = []
+        error: Optional[Exception] = None
+        for batch in batches.values():
+            try:
+                _write_log_rows(batch)
+                continue
+            except Exception as exc:
+                error = exc
+            if len(batch) == 1:
+                failed.extend(batch)
+                continue
+            logger.warning("Batch write of %d email events failed (%s); writing them one by one", len(batch), error)
+            for row in batch:
+                try:
+                    _write_log_rows([row])
+                except Exception as exc:
+                    failed.append(row)
+                    error = exc
+        if not failed:
+            return
+
+        retry = []
+        for db, event_row, prediction_row, attempts in failed:
+            if attempts + 1 >= LOG_MAX_ATTEMPTS:
+                logger.error(
+                    "Dropping email event for user_id=%s after %d failed writes",
+                    event_row.get("user_id"), attempts + 1,
+                )
+            else:
+                retry.append((db, event_row, prediction_row, attempts + 1))
+        if retry:
+            with _LOG_COND:
+                _LOG_ROWS[:0] = retry
+        raise error
+
+
+def _log_flusher() -> None:
+    delay = 0.0
+    while True:
+        with _LOG_COND:
+            while not _LOG_ROWS and not _LOG_STOPPING:
+                _LOG_COND.wait()
+            if len(_LOG_ROWS) < LOG_BATCH_SIZE and not _LOG_STOPPING:
+                _LOG_COND.wait(LOG_FLUSH_SECS)
+            stopping = _LOG_STOPPING
+        try:
+            flush_db_log()
+            delay = 0.0
+        except Exception:
+            delay = min(delay * 2 or LOG_RETRY_SECS, LOG_RETRY_MAX_SECS)
+            logger.exception("Failed to write buffered email events; retrying in %.1fs", delay)
+            time.sleep(delay)
+            continue
+        if stopping:
+            return
+
+
+def _start_log_flusher() -> None:
+    global _LOG_THREAD, _LOG_STOPPING
+    with _LOG_COND:
+        if _LOG_THREAD is None or not _LOG_THREAD.is_alive():
+            _LOG_STOPPING = False
+            _LOG_THREAD = threading.Thread(target=_log_flusher, name="db-log", daemon=True)
+            _LOG_THREAD.start()
+
+
+def stop_db_log(timeout: float = 10.0) -> None:
+    """Write the rows still buffered and stop the background writer."""
+    global _LOG_THREAD, _LOG_STOPPING
+    with _LOG_COND:
+        thread, _LOG_THREAD = _LOG_THREAD, None
+        _LOG_STOPPING = True
+        _LOG_COND.notify()
+    if thread is not None:
+        thread.join(timeout)
+
+
+_REPLY_BODY_TMPL = "\n".join((
+    "Phishing Scan Result",
+    "=" * 40,
+    "Scanned email : {subject}",
+    "Verdict       : {verdict}",
+    "Risk level    : {risk_level}",
+    "Checked via   : {reason}",
+    "=" * 40,
+    "{action}",
+    "",
+    "-- Phishing Detection System",
+))
+
+
 def send_scan_reply(
     to_addr: str,
     original_subject: str,
@@ -74,17 +266,22 @@ def send_scan_reply(
     risk_level: str,
     reason: str,
     user_id: int | None = None,
+    db: Optional[DatabaseManager] = None,
 ) -> None:
-    """Send a scan-result email back to the user's forwarding address.
+    """Queue a scan-result email back to the user's forwarding address.
 
-    Only sends when both the global --reply flag AND the user's per-account
-    email alerts preference are enabled.
+    The reply goes out from a background thread, so the SMTP handler never
+    waits on the relay. Only sends when both the global --reply flag AND the user's per-account
+    email alerts preference are enabled. The preference is read from ``db``,
+    or from ``DB_MANAGER`` when it is not given.
     """
     if not REPLY_CFG.get("enabled"):
         return
 
-    if user_id is not None and DB_MANAGER is not None:
-        if not DB_MANAGER.get_email_alerts_enabled(user_id):
+    if db is None:
+        db = DB_MANAGER
+    if user_id is not None and db is not None:
+        if not db.get_email_alerts_enabled(user_id):
             return
 
     pct = phishing_probability * 100
@@ -97,16 +294,12 @@ def send_scan_reply(
 
     scanned_subject = original_subject.strip() if original_subject else "(no subject)"
 
-    body = (
-        f"Phishing Scan Result\n"
-        f"{'=' * 40}\n"
-        f"Scanned email : {scanned_subject}\n"
-        f"Verdict       : {verdict_line}\n"
-        f"Risk level    : {risk_level}\n"
-        f"Checked via   : {reason}\n"
-        f"{'=' * 40}\n"
-        f"{action_line}\n\n"
-        f"-- Phishing Detection System"
+    body = _REPLY_BODY_TMPL.format(
+        subject=scanned_subject,
+        verdict=verdict_line,
+        risk_level=risk_level,
+        reason=reason,
+        action=action_line,
     )
 
     msg = MIMEText(body, "plain", "utf-8")
@@ -115,152 +308,320 @@ def send_scan_reply(
     msg["Date"]    = formatdate(localtime=True)
     msg["Subject"] = f"[Phishing Scan] {'⚠ PHISHING' if predicted_label == 'phishing' else '✔ Safe'} – {scanned_subject}"
 
-    try:
-        with smtplib.SMTP(REPLY_CFG["host"], REPLY_CFG["port"], timeout=10) as relay:
-            relay.sendmail(REPLY_CFG["from_addr"], [to_addr], msg.as_bytes())
-        print(f"REPLY     sent to {to_addr}")
-    except Exception as exc:
-        print(f"REPLY     FAILED to {to_addr}: {exc}")
-
+    _start_reply_worker()
+    _REPLY_QUEUE.put((to_addr, msg.as_bytes()))
 
-def handle_smtp_email(sender_email, recipients, raw_message):
-    if DB_MANAGER is None or DETECTOR is None:
-        raise RuntimeError("SMTP server not initialized")
 
-    user = DB_MANAGER.get_user_by_email_hash(hash_email(sender_email))
-    if not user:
-        print(f"DISCARDED: Unregistered sender {sender_email}")
-        return "550 Rejected - sender not registered"
+def _send_reply(relay: Optional[smtplib.SMTP], to_addr: str, payload: bytes) -> smtplib.SMTP:
+    """Send one reply and return the connection to reuse for the next one."""
+    if relay is not None:
+        try:
+            relay.sendmail(REPLY_CFG["from_addr"], [to_addr], payload)
+            return relay
+        except smtplib.SMTPServerDisconnected:
+            pass  # the relay dropped the idle connection; reconnect below
 
-    extracted = DETECTOR.preprocess_email(raw_message)
-    if not extracted:
-        print(f"DISCARDED: Failed preprocessing for user_id={user.id}")
-        return "550 Rejected - message could not be parsed"
+    relay = _connect_relay()
+    try:
+        relay.sendmail(REPLY_CFG["from_addr"], [to_addr], payload)
+    except Exception:
+        _close_relay(relay)
+        raise
+    return relay
 
-    original_sender = extracted.get("original_sender")
-    original_domain = get_sender_domain(original_sender) if original_sender else None
 
-    if not original_sender:
+def _relay_addresses(host: str, port: int) -> list[str]:
+    key = (host, port)
+    now = time.monotonic()
+    cached = _RELAY_ADDRS.get(key)
+    if cached is not None and now - cached[0] < RELAY_DNS_TTL:
+        return cached[1]
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        # Let smtplib resolve it and report the error.
+        return [host]
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    if addresses:
+        _RELAY_ADDRS[key] = (now, addresses)
+    return addresses
+
+
+def _connect_relay() -> smtplib.SMTP:
+    host, port = REPLY_CFG["host"], REPLY_CFG["port"]
+    error: OSError = smtplib.SMTPConnectError(-1, f"no address found for relay {host}:{port}")
+    # Same address-by-address fallback as socket.create_connection.
+    for address in _relay_addresses(host, port):
         try:
-            raw_msg_obj = BytesParser(policy=policy.default).parsebytes(
-                raw_message if isinstance(raw_message, bytes) else raw_message.encode(errors="ignore")
-            )
-            from_header = raw_msg_obj.get("From", "")
-            from_match = re.search(
-                r"([a-z0-9._%+\-]+@[a-z0-9.\-]+\.[a-z]{2,})", from_header, re.IGNORECASE
-            )
-            if from_match:
-                original_sender = from_match.group(1).lower()
-                original_domain = get_sender_domain(original_sender)
-        except Exception as exc:
-            print(f"WARN      failed From-header parse for user_id={user.id}: {exc}")
+            return smtplib.SMTP(address, port, timeout=10)
+        except OSError as exc:
+            error = exc
+    raise error
 
-    check_address = original_sender if original_sender else sender_email
-    check_domain  = original_domain if original_domain else get_sender_domain(sender_email)
 
-    message_id_hash = _message_id_hash(raw_message)
+def _close_relay(relay: Optional[smtplib.SMTP]) -> None:
+    if relay is None:
+        return
+    try:
+        relay.quit()
+    except Exception:
+        relay.close()
 
-    email_event = DB_MANAGER.log_email_event(
-        user_id=user.id,
-        sender_domain=check_domain,
-        is_forwarded=bool(original_sender),
-        message_id_hash=message_id_hash,
-    )
 
-    trusted_address: Optional[str] = None
-    if DETECTOR.is_whitelisted(check_address):
-        trusted_address = check_address
-    elif DB_MANAGER.is_trusted_domain(user.id, check_domain):
-        trusted_address = check_address
-
-    if trusted_address:
-        predicted_label = "legitimate"
-        phishing_probability = 0.0
-        risk_level = "LOW"
-        reason = "trusted_domain"
-        print(
-            f"TRUSTED  user_id={user.id} | {trusted_address} -> skipping model"
-        )
-    else:
-        prediction = DETECTOR.classify_email(extracted["subject"], extracted["body"])
-        predicted_label = prediction["label"]
-        phishing_probability = prediction["probability"]
-        if predicted_label == "legitimate":
-            phishing_probability = 1.0 - phishing_probability
-        risk_level = _phishing_risk_level(phishing_probability)
-        reason = "model_prediction"
-
-    DB_MANAGER.log_prediction(
-        email_event_id=email_event.id,
-        model_version=MODEL_VERSION,
-        phishing_prob=phishing_probability,
-        predicted_label=predicted_label,
-        risk_level=risk_level,
-    )
+def _reply_worker() -> None:
+    relay: Optional[smtplib.SMTP] = None
+    while True:
+        item = _REPLY_QUEUE.get()
+        if item is None:
+            break
+        to_addr, payload = item
+        try:
+            relay = _send_reply(relay, to_addr, payload)
+            logger.info("REPLY     sent to %s", to_addr)
+        except Exception as exc:
+            logger.warning("REPLY     FAILED to %s: %s", to_addr, exc)
+            # Start the next reply on a fresh connection.
+            _close_relay(relay)
+            relay = None
+    _close_relay(relay)
+
+
+def _start_reply_worker() -> None:
+    global _REPLY_THREAD
+    with _REPLY_THREAD_LOCK:
+        if _REPLY_THREAD is None or not _REPLY_THREAD.is_alive():
+            _REPLY_THREAD = threading.Thread(target=_reply_worker, name="scan-reply", daemon=True)
+            _REPLY_THREAD.start()
+
+
+def stop_reply_worker(timeout: float = 10.0) -> None:
+    """Send the replies still queued, then close the relay connection."""
+    global _REPLY_THREAD
+    with _REPLY_THREAD_LOCK:
+        thread, _REPLY_THREAD = _REPLY_THREAD, None
+    if thread is not None:
+        _REPLY_QUEUE.put(None)
+        thread.join(timeout)
+
+
+class SMTPRouter:
+    """aiosmtpd handler that scans mail from registered users.
+
+    The database, detector, model version and reply switch are bound once
+    here instead of being read from the module globals for every message.
+    ``reply_cfg["enabled"]`` is read at construction; the relay settings are
+    still read from ``REPLY_CFG`` by the reply worker.
+    """
 
-    print(
-        f"PROCESSED user_id={user.id} | {predicted_label.upper()} "
-        f"{phishing_probability:.2%} [{risk_level}] via {reason}"
-    )
+    def __init__(
+        self,
+        db: DatabaseManager,
+        detector: PhishingDetector,
+        model_version: str,
+        reply_cfg: Optional[dict] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.db = db
+        self.detector = detector
+        self.model_version = model_version
+        self.reply_enabled = bool((REPLY_CFG if reply_cfg is None else reply_cfg).get("enabled"))
+        self.executor = executor
+        self._trusted_domains: dict[int, tuple[float, frozenset[str]]] = {}
+        db.add_trust_listener(self._forget_trusted_domains)
+
+    def _trusted_domains_for(self, user_id: int) -> frozenset[str]:
+        now = time.monotonic()
+        entry = self._trusted_domains.get(user_id)
+        if entry is not None and now - entry[0] < TRUSTED_CACHE_TTL:
+            return entry[1]
+        domains = self.db.get_trusted_domain_set(user_id)
+        self._trusted_domains[user_id] = (now, domains)
+        return domains
+
+    def _forget_trusted_domains(self, user_id: int) -> None:
+        self._trusted_domains.pop(user_id, None)
+
+    def _is_trusted_domain(self, user_id: int, domain: str) -> bool:
+        return domain in self._trusted_domains_for(user_id)
+
+    def handle(self, sender_email, recipients, raw_message):
+        db = self.db
+        detector = self.detector
+
+        sender_hash = hash_email(sender_email)
+        user = db.get_user_by_email_hash(sender_hash)
+        if not user:
+            logger.info("DISCARDED: Unregistered sender %s", sender_email)
+            return "550 Rejected - sender not registered"
+
+        # Parsed once; the detector and the header lookups below share it.
+        msg = parse_email(raw_message)
+
+        extracted = detector.preprocess_email(msg)
+        if not extracted:
+            logger.info("DISCARDED: Failed preprocessing for user_id=%s", user.id)
+            return "550 Rejected - message could not be parsed"
+
+        original_sender = extracted.get("original_sender")
+        original_domain = get_sender_domain(original_sender) if original_sender else None
+
+        if not original_sender:
+            try:
+                from_header = msg.get("From", "")
+                from_match = re.search(
+                    r"([a-z0-9._%+\-]+@[a-z0-9.\-]+\.[a-z]{2,})", from_header, re.IGNORECASE
+                )
+                if from_match:
+                    original_sender = from_match.group(1).lower()
+                    original_domain = get_sender_domain(original_sender)
+            except Exception as exc:
+                logger.warning("failed From-header parse for user_id=%s: %s", user.id, exc)
+
+        check_address = original_sender if original_sender else sender_email
+        check_domain  = original_domain if original_domain else get_sender_domain(sender_email)
+
+        message_id_hash = _message_id_hash(extracted.get("message_id"))
+
+        trusted_address = detector.check_trust(user.id, check_address, check_domain, self._is_trusted_domain)
+
+        if trusted_address:
+            predicted_label = "legitimate"
+            phishing_probability = 0.0
+            risk_level = "LOW"
+            reason = "trusted_domain"
+            logger.info("TRUSTED  user_id=%s | %s -> skipping model", user.id, trusted_address)
+        else:
+            prediction = detector.classify_email(extracted["subject"], extracted["body"])
+            predicted_label = prediction["label"]
+            phishing_probability, risk_level = _finalize_prediction(predicted_label, prediction["probability"])
+            reason = "model_prediction"
+
+        _queue_db_log(
+            db,
+            {
+                "user_id": user.id,
+                "sender_domain": check_domain,
+                "is_forwarded": bool(original_sender),
+                "message_id_hash": message_id_hash,
+            },
+            {
+                "model_version": self.model_version,
+                "phishing_prob": phishing_probability,
+                "predicted_label": predicted_label,
+                "risk_level": risk_level,
+            },
+        )
 
-    send_scan_reply(
-        to_addr=sender_email,
-        original_subject=extracted.get("original_subject", ""),
-        predicted_label=predicted_label,
-        phishing_probability=phishing_probability,
-        risk_level=risk_level,
-        reason=reason,
-        user_id=user.id,
-    )
+        logger.info(
+            "PROCESSED user_id=%s | %s %.2f%% [%s] via %s",
+            user.id, predicted_label.upper(), phishing_probability * 100, risk_level, reason,
+        )
 
-    return "250 OK - processed successfully"
+        if self.reply_enabled:
+            send_scan_reply(
+                to_addr=sender_email,
+                original_subject=extracted.get("original_subject", ""),
+                predicted_label=predicted_label,
+                phishing_probability=phishing_probability,
+                risk_level=risk_level,
+                reason=reason,
+                user_id=user.id,
+                db=db,
+            )
 
+        return "250 OK - processed successfully"
 
-class RegisteredUserSMTPHandler:
     async def handle_DATA(self, server, session, envelope):
         try:
-            return handle_smtp_email(
-                sender_email=envelope.mail_from,
-                recipients=envelope.rcpt_tos,
-                raw_message=envelope.content,
+            # DB writes and inference block, so other SMTP sessions keep
+            # being served while this message is processed.
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor,
+                self.handle,
+                envelope.mail_from,
+                envelope.rcpt_tos,
+                envelope.content,
             )
         except Exception as exc:
-            print(f"ERROR: Handler failure {exc}")
-            traceback.print_exc()
+            logger.exception("Handler failure %s", exc)
             return "421 Temp fail - try again later"
 
 
-def _resolve_whitelist(args) -> Optional[set[str]]:
+_GLOBAL_ROUTER: Optional[SMTPRouter] = None
+
+
+def handle_smtp_email(sender_email, recipients, raw_message):
+    """Scan one message with a router built from the module globals.
+
+    The router, and so its caches, is reused until one of the globals changes.
+    """
+    global _GLOBAL_ROUTER
+    if DB_MANAGER is None or DETECTOR is None:
+        raise RuntimeError("SMTP server not initialized")
+    router = _GLOBAL_ROUTER
+    if (
+        router is None
+        or router.db is not DB_MANAGER
+        or router.detector is not DETECTOR
+        or router.model_version != MODEL_VERSION
+    ):
+        router = _GLOBAL_ROUTER = SMTPRouter(DB_MANAGER, DETECTOR, MODEL_VERSION)
+    return router.handle(sender_email, recipients, raw_message)
+
+
+_BUILTIN_WHITELIST: frozenset[str] = frozenset((
+    "google.com",
+    "redditmail.com",
+    "reddit.com",
+    "github.com",
+    "microsoft.com",
+    "amazon.com",
+    "paypal.com",
+    "apple.com",
+    "linkedin.com",
+    "twitter.com",
+    "facebook.com",
+    "instagram.com",
+))
+
+
+def _resolve_whitelist(args) -> Optional[frozenset[str]]:
     if args.no_whitelist:
-        return set()
+        return frozenset()
     if not args.whitelist:
         return None
-    defaults = {
-        "google.com",
-        "redditmail.com",
-        "reddit.com",
-        "github.com",
-        "microsoft.com",
-        "amazon.com",
-        "paypal.com",
-        "apple.com",
-        "linkedin.com",
-        "twitter.com",
-        "facebook.com",
-        "instagram.com",
-    }
-    defaults.update({domain.lower() for domain in args.whitelist})
-    return defaults
+    return _BUILTIN_WHITELIST.union(domain.lower() for domain in args.whitelist)
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """A uvloop loop when uvloop is installed, else the stock asyncio loop."""
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
 
 
 def start_controller(handler, host: str, port: int) -> Controller:
-    controller = Controller(handler, hostname=host, port=port)
+    # The controller serves SMTP on its own thread and loop.
+    controller = Controller(handler, hostname=host, port=port, loop=new_event_loop())
     controller.start()
     print(f"SMTP router listening on {host}:{port}")
     print("Waiting for emails... (Ctrl+C to quit)")
     return controller
 
 
+async def _wait_for_shutdown() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C still arrives as KeyboardInterrupt
+            pass
+    await stop.wait()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="SMTP router for phishing detector")
     parser.add_argument("--host", default="localhost", help="SMTP bind host")
@@ -297,12 +658,19 @@ def main() -> None:
         default="phishing-scanner@localhost",
         help="From address used in scan-result reply emails",
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log detector preprocessing details for every email",
+    )
 
     args = parser.parse_args()
 
     whitelist = _resolve_whitelist(args)
 
-    global DB_MANAGER, DETECTOR, MODEL_VERSION, REPLY_CFG
+    log_listener = start_queue_logging(logging.DEBUG if args.verbose else logging.INFO)
+
+    global DB_MANAGER, DETECTOR, EXECUTOR, MODEL_VERSION, REPLY_CFG
     REPLY_CFG["enabled"]   = args.reply
     REPLY_CFG["host"]      = args.reply_host
     REPLY_CFG["port"]      = args.reply_port
@@ -320,17 +688,23 @@ def main() -> None:
         whitelist_domains=whitelist,
     )
     MODEL_VERSION = Path(DETECTOR.model_path).stem
+    EXECUTOR = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="smtp-handler")
 
-    handler = RegisteredUserSMTPHandler()
+    handler = SMTPRouter(DB_MANAGER, DETECTOR, MODEL_VERSION, REPLY_CFG, EXECUTOR)
     controller = start_controller(handler, args.host, args.port)
 
     try:
-        asyncio.get_event_loop().run_forever()
+        asyncio.run(_wait_for_shutdown())
     except KeyboardInterrupt:
-        print("\nShutting down SMTP router...")
+        pass
     finally:
+        print("\nShutting down SMTP router...")
         controller.stop()
+        EXECUTOR.shutdown(wait=True)
+        stop_db_log()
+        stop_reply_worker()
         print("SMTP router stopped")
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
-import csv
 import os
 import re
 import warnings
+from multiprocessing import Pool
+from typing import Optional
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pcsv
 
 warnings.filterwarnings("ignore")
 
@@ -11,36 +14,107 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 RAW_DIR = os.path.join(BASE_DIR, "data", "raw")
 OUT_PATH = os.path.join(BASE_DIR, "data", "final_cleaned_dataset.csv")
 
+MASTER = re.compile(
+    r"(?P<tag><[^>]+>)"
+    r"|(?P<nbsp>&nbsp;)|(?P<amp>&amp;)|(?P<lt>&lt;)|(?P<gt>&gt;)"
+    r"|(?P<quot>&quot;)|(?P<apos>&apos;)"
+    r"|(?P<num>&#\d+;)|(?P<ent>&\w+;)",
+    re.IGNORECASE,
+)
+MASTER_REPL = {
+    "tag": " ",
+    "nbsp": " ",
+    "amp": "&",
+    "lt": "<",
+    "gt": ">",
+    "quot": '"',
+    "apos": "'",
+    "num": " ",
+    "ent": " ",
+}
+MULTISPACE_RE = re.compile(r" {2,}")
+PARALLEL_MIN_ROWS = 20_000
+PREFIX_LEN = 256
+WS_TABLE = str.maketrans({"\r": " ", "\n": " ", "\t": " "})
+
+def _dispatch(match: re.Match) -> str:
+    return MASTER_REPL[match.lastgroup]
+
 def clean_email_text(text: object) -> str:
     if not isinstance(text, str):
         return ""
 
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"&nbsp;", " ", text, flags=re.IGNORECASE)
-    text = re.sub(r"&amp;", "&", text, flags=re.IGNORECASE)
-    text = re.sub(r"&lt;", "<", text, flags=re.IGNORECASE)
-    text = re.sub(r"&gt;", ">", text, flags=re.IGNORECASE)
-    text = re.sub(r"&quot;", '"', text, flags=re.IGNORECASE)
-    text = re.sub(r"&apos;", "'", text, flags=re.IGNORECASE)
-    text = re.sub(r"&\w+;", " ", text)
+    text = text.translate(WS_TABLE)
+
+    text = MASTER.sub(_dispatch, text)
+
+    return MULTISPACE_RE.sub(" ", text).strip()
+
+def vector_clean(series: pd.Series) -> pd.Series:
+    """Column-wise equivalent of ``clean_email_text`` using ``Series.str``."""
+    if isinstance(series.dtype, pd.StringDtype):
+        s = series.fillna("")
+    else:
+        s = series.where(series.map(lambda v: isinstance(v, str)), "")
+
+    s = s.str.translate(WS_TABLE)
+
+    s = s.str.replace(MASTER, _dispatch, regex=True)
 
-    text = text.replace("\r\n", " ").replace("\r", " ").replace("\n", " ").replace("\t", " ")
+    # Plain-string patterns let Arrow-backed columns use Arrow's compute kernels.
+    return s.str.replace(MULTISPACE_RE.pattern, " ", regex=True).str.strip()
 
-    text = re.sub(r" {2,}", " ", text).strip()
+def parallel_clean(series: pd.Series) -> pd.Series:
+    """Clean a column across all cores; small columns stay on ``vector_clean``."""
+    if len(series) <= PARALLEL_MIN_ROWS:
+        return vector_clean(series)
+    with Pool() as pool:
+        cleaned = pool.map(clean_email_text, series.tolist(), chunksize=2000)
+    return pd.Series(cleaned, index=series.index, dtype=object)
 
-    text = text.replace('"', '""')
+def dedupe_bodies(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop rows with a repeated body, keeping the first occurrence.
 
-    return text
+    Rows are blocked on a 64-bit hash of the first ``PREFIX_LEN`` characters
+    and only rows that share a prefix hash get their full body hashed, so
+    most bodies are never hashed past their opening bytes. Keys are ints,
+    not multi-KB strings; collisions are negligible at this row count.
+    """
+    body = df["body"]
+    prefix = pd.util.hash_pandas_object(body.str.slice(0, PREFIX_LEN), index=False)
+    candidates = prefix.duplicated(keep=False)
 
-def _read(filename: str, **kwargs) -> pd.DataFrame:
+    keep = ~candidates
+    full = pd.util.hash_pandas_object(body[candidates], index=False)
+    keep[candidates] = ~full.duplicated(keep="first").to_numpy()
+    return df[keep].reset_index(drop=True)
+
+def _read(filename: str, usecols: Optional[list[str]] = None, **kwargs) -> pd.DataFrame:
     path = os.path.join(RAW_DIR, filename)
+    # Parsed CSVs are cached next to the source as Parquet; the cache is
+    # reused until the CSV is modified again.
+    cache_path = path + ".parquet"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            return pd.read_parquet(cache_path, columns=usecols)
+        except Exception:
+            # Cache was written for a different column set; re-parse below.
+            pass
+
     try:
-        return pd.read_csv(path, on_bad_lines="skip", encoding="utf-8", **kwargs)
+        df = pd.read_csv(path, on_bad_lines="skip", encoding="utf-8", usecols=usecols, **kwargs)
     except (UnicodeDecodeError, Exception):
-        return pd.read_csv(path, on_bad_lines="skip", encoding="latin-1", **kwargs)
+        df = pd.read_csv(path, on_bad_lines="skip", encoding="latin-1", usecols=usecols, **kwargs)
+
+    try:
+        df.to_parquet(cache_path, compression="zstd")
+    except Exception:
+        # Mixed-type columns cannot be written as Parquet; re-parse next run.
+        pass
+    return df
 
 def load_phishtank() -> pd.DataFrame:
-    df = _read("verified_online_PhishTank.csv")
+    df = _read("verified_online_PhishTank.csv", usecols=["url"])
     return pd.DataFrame({
         "subject": "",
         "body": df["url"].astype(str),
@@ -50,47 +124,63 @@ def load_phishtank() -> pd.DataFrame:
     })
 
 def load_ceas08() -> pd.DataFrame:
-    df = _read("CEAS_08.csv")
+    df = _read(
+        "CEAS_08.csv",
+        usecols=["subject", "body", "urls", "label"],
+        dtype={"label": "int8"},
+    )
     return pd.DataFrame({
         "subject": df["subject"],
         "body": df["body"],
-        "has_urls": df["urls"].apply(lambda x: 1 if x else 0),
+        "has_urls": df["urls"].fillna(0).astype(bool).astype("int8"),
         "label": df["label"],
         "source_dataset": "CEAS_08",
     })
 
 def load_nazario() -> pd.DataFrame:
-    df = _read("Nazario.csv")
+    df = _read(
+        "Nazario.csv",
+        usecols=["subject", "body", "urls", "label"],
+        dtype={"label": "int8"},
+    )
     return pd.DataFrame({
         "subject": df["subject"],
         "body": df["body"],
-        "has_urls": df["urls"].apply(lambda x: 1 if x else 0),
+        "has_urls": df["urls"].fillna(0).astype(bool).astype("int8"),
         "label": df["label"],
         "source_dataset": "Nazario",
     })
 
 def load_spamassasin() -> pd.DataFrame:
-    df = _read("SpamAssasin.csv")
+    df = _read(
+        "SpamAssasin.csv",
+        usecols=["subject", "body", "urls", "label"],
+        dtype={"label": "int8"},
+    )
     return pd.DataFrame({
         "subject": df["subject"],
         "body": df["body"],
-        "has_urls": df["urls"].apply(lambda x: 1 if x else 0),
+        "has_urls": df["urls"].fillna(0).astype(bool).astype("int8"),
         "label": df["label"],
         "source_dataset": "SpamAssasin",
     })
 
 def load_nigerian_fraud() -> pd.DataFrame:
-    df = _read("Nigerian_Fraud.csv")
+    df = _read(
+        "Nigerian_Fraud.csv",
+        usecols=["subject", "body", "urls", "label"],
+        dtype={"label": "int8"},
+    )
     return pd.DataFrame({
         "subject": df["subject"],
         "body": df["body"],
-        "has_urls": df["urls"].apply(lambda x: 1 if x else 0),
+        "has_urls": df["urls"].fillna(0).astype(bool).astype("int8"),
         "label": df["label"],
         "source_dataset": "Nigerian_Fraud",
     })
 
 def load_enron() -> pd.DataFrame:
-    df = _read("Enron.csv")
+    df = _read("Enron.csv", usecols=["subject", "body", "label"], dtype={"label": "int8"})
     return pd.DataFrame({
         "subject": df["subject"],
         "body": df["body"],
@@ -100,7 +190,7 @@ def load_enron() -> pd.DataFrame:
     })
 
 def load_ling() -> pd.DataFrame:
-    df = _read("Ling.csv")
+    df = _read("Ling.csv", usecols=["subject", "body", "label"], dtype={"label": "int8"})
     return pd.DataFrame({
         "subject": df["subject"],
         "body": df["body"],
@@ -110,7 +200,7 @@ def load_ling() -> pd.DataFrame:
     })
 
 def load_phishing_email() -> pd.DataFrame:
-    df = _read("phishing_email.csv")
+    df = _read("phishing_email.csv", usecols=["text_combined", "label"], dtype={"label": "int8"})
     return pd.DataFrame({
         "subject": "",
         "body": df["text_combined"],
@@ -142,61 +232,70 @@ def main() -> None:
         frames.append(df)
 
     merged = pd.concat(frames, ignore_index=True)
+    for col in ("subject", "body"):
+        text = merged[col]
+        merged[col] = text.where(text.map(lambda v: isinstance(v, str))).astype("string[pyarrow]")
+    merged["source_dataset"] = merged["source_dataset"].astype("category")
     print(f"\n  Total merged rows: {len(merged):,}")
 
+    # Rows with an identical raw body also clean identically, so drop them
+    # before the expensive cleaning pass. Which rows survive is unchanged.
+    before = len(merged)
+    merged = dedupe_bodies(merged)
+    print(f"  Exact duplicates skipped before cleaning: {before - len(merged):,}")
+
     print("\n  Cleaning subject & body columns …")
-    merged["subject"] = merged["subject"].apply(clean_email_text)
-    merged["body"]    = merged["body"].apply(clean_email_text)
+    merged["subject"] = parallel_clean(merged["subject"])
+    merged["body"]    = parallel_clean(merged["body"])
     print("  ✓ Cleaning complete.")
 
-    merged["has_urls"] = merged["has_urls"].astype(int)
-    merged["label"]    = merged["label"].astype(int)
+    merged["has_urls"] = merged["has_urls"].astype("int8")
+    merged["label"]    = merged["label"].astype("int8")
 
-    before = len(merged)
-    merged.drop_duplicates(subset=["body"], keep="first", inplace=True)
-    merged.reset_index(drop=True, inplace=True)
+    merged = dedupe_bodies(merged)
     print(f"\n  Deduplication: {before:,} → {len(merged):,}  "
           f"(removed {before - len(merged):,} duplicates)")
 
+    label_counts = merged["label"].value_counts()
     print(f"\n  Label distribution after dedup:")
-    for lbl in sorted(merged["label"].unique()):
+    for lbl in sorted(label_counts.index):
         tag = "Phishing" if lbl == 1 else "Legitimate"
-        print(f"    label={lbl} ({tag:>10s}): {(merged['label'] == lbl).sum():>6,}")
+        print(f"    label={lbl} ({tag:>10s}): {label_counts[lbl]:>6,}")
 
     SAMPLE_PER_CLASS = 5_000
-    phishing   = merged[merged["label"] == 1]
-    legitimate = merged[merged["label"] == 0]
-
-    if len(phishing) < SAMPLE_PER_CLASS:
-        raise ValueError(
-            f"Not enough phishing rows ({len(phishing)}) to sample {SAMPLE_PER_CLASS}."
-        )
-    if len(legitimate) < SAMPLE_PER_CLASS:
-        raise ValueError(
-            f"Not enough legitimate rows ({len(legitimate)}) to sample {SAMPLE_PER_CLASS}."
-        )
-
-    phishing_sample   = phishing.sample(n=SAMPLE_PER_CLASS, random_state=42)
-    legitimate_sample  = legitimate.sample(n=SAMPLE_PER_CLASS, random_state=42)
-
-    final = pd.concat([phishing_sample, legitimate_sample], ignore_index=True)
-    final = final.sample(frac=1, random_state=42).reset_index(drop=True)
+    for lbl, tag in ((1, "phishing"), (0, "legitimate")):
+        available = int(label_counts.get(lbl, 0))
+        if available < SAMPLE_PER_CLASS:
+            raise ValueError(
+                f"Not enough {tag} rows ({available}) to sample {SAMPLE_PER_CLASS}."
+            )
+
+    final = (
+        merged.groupby("label", group_keys=False)
+        .sample(n=SAMPLE_PER_CLASS, random_state=42)
+        .sample(frac=1, random_state=42)
+        .reset_index(drop=True)
+    )
 
+    final_counts = final["label"].value_counts()
     print(f"\n  Final dataset : {len(final):,} rows  "
-          f"(Phishing={len(final[final['label']==1]):,}, "
-          f"Legitimate={len(final[final['label']==0]):,})")
+          f"(Phishing={final_counts.get(1, 0):,}, "
+          f"Legitimate={final_counts.get(0, 0):,})")
 
     final.fillna("", inplace=True)
 
     os.makedirs(os.path.dirname(OUT_PATH), exist_ok=True)
-    final.to_csv(
+    # Arrow quotes every field and escapes embedded quotes itself.
+    pcsv.write_csv(
+        pa.Table.from_pandas(final, preserve_index=False),
         OUT_PATH,
-        index=False,
-        quoting=csv.QUOTE_ALL,
-        encoding="utf-8",
+        write_options=pcsv.WriteOptions(quoting_style="all_valid"),
     )
+    parquet_path = os.path.splitext(OUT_PATH)[0] + ".parquet"
+    final.to_parquet(parquet_path, compression="zstd", index=False)
 
     print(f"\n  ✓ Saved → {OUT_PATH}")
+    print(f"  ✓ Saved → {parquet_path}")
     print(f"  Columns : {list(final.columns)}")
     print("=" * 60)
 
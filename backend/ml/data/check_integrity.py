@@ -2,38 +2,67 @@ import csv
 import os
 import sys
 
-# Increase the CSV field size limit to handle large email bodies
-# On Windows, sys.maxsize can exceed C long limits, so we use the max 32-bit integer
-csv.field_size_limit(2147483647)
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pcsv
 
 # Get the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Construct the full path to the CSV file
 file_path = os.path.join(script_dir, 'final_cleaned_dataset.csv')
+# Parquet sibling written alongside the CSV by clean_and_merge.py
+parquet_path = os.path.splitext(file_path)[0] + '.parquet'
 
 expected_column_count = 5  # subject, body, has_urls, label, source_dataset
 
+if os.path.exists(parquet_path):
+    # Parquet rows cannot be ragged, so the schema in the footer is enough.
+    print(f"Checking file: {parquet_path}...")
+    column_count = len(pq.read_schema(parquet_path).names)
+    if column_count == expected_column_count:
+        print("✅ Success! All rows have the correct column count.")
+        sys.exit(0)
+    print(f"❌ Found {column_count} columns, expected {expected_column_count}.")
+    sys.exit(1)
+
 if not os.path.exists(file_path):
     print(f"❌ Error: File not found at {file_path}")
     exit(1)
 
 print(f"Checking file: {file_path}...")
 
-with open(file_path, 'r', encoding='utf-8') as f:
-    reader = csv.reader(f)
-    header = next(reader, None)  # Skip the header row
-    
-    if header and len(header) != expected_column_count:
-         print(f"⚠️ Warning: Header has {len(header)} columns, expected {expected_column_count}")
-
-    error_count = 0
-    for i, row in enumerate(reader, start=2): # Start counting from line 2 (since line 1 is header)
-        if len(row) != expected_column_count:
-            print(f"⚠️ Error at Line {i}: Found {len(row)} columns instead of {expected_column_count}")
-            print(f"Row Content Snippet: {row[:2]}...")
-            error_count += 1
-
-    if error_count == 0:
-        print("✅ Success! All rows have the correct column count.")
-    else:
-        print(f"❌ Found {error_count} broken rows.")
+with open(file_path, 'r', encoding='utf-8', newline='') as f:
+    header = next(csv.reader(f), None)
+
+if header and len(header) != expected_column_count:
+     print(f"⚠️ Warning: Header has {len(header)} columns, expected {expected_column_count}")
+
+# Rows are parsed natively by Arrow and checked against expected_column_count;
+# mismatched rows are reported to the handler and skipped.
+errors = []
+
+def on_bad_row(row):
+    errors.append(row)
+    return "skip"
+
+column_names = [f"col{i}" for i in range(expected_column_count)]
+reader = pcsv.open_csv(
+    file_path,
+    read_options=pcsv.ReadOptions(column_names=column_names, skip_rows=1),
+    parse_options=pcsv.ParseOptions(newlines_in_values=True, invalid_row_handler=on_bad_row),
+    convert_options=pcsv.ConvertOptions(column_types=dict.fromkeys(column_names, pa.string())),
+)
+for _ in reader:
+    pass
+
+for row in errors:
+    # Arrow cannot number rows when values may span lines
+    where = f"Line {row.number}" if row.number is not None else "an unknown line"
+    print(f"⚠️ Error at {where}: Found {row.actual_columns} columns instead of {expected_column_count}")
+    print(f"Row Content Snippet: {row.text[:80]}...")
+
+error_count = len(errors)
+if error_count == 0:
+    print("✅ Success! All rows have the correct column count.")
+else:
+    print(f"❌ Found {error_count} broken rows.")
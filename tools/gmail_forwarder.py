@@ -12,6 +12,12 @@ def _imap_connect(gmail_user, gmail_password, folder):
     mail.select(folder)
     return mail
 
+def _close_smtp(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
 def fetch_and_forward_gmail(gmail_user, gmail_password, 
                             smtp_host='localhost', smtp_port=1025,
                             folder='INBOX', limit=5, search_criteria='ALL'):
@@ -35,49 +41,64 @@ def fetch_and_forward_gmail(gmail_user, gmail_password,
         email_ids = email_ids[-limit:] if len(email_ids) > limit else email_ids
         print(f"Found {len(email_ids)} email(s) to process\n")
         
-        for i, email_id in enumerate(email_ids, 1):
-            print(f"{'-'*70}")
-            print(f"Processing email {i}/{len(email_ids)}...")
-            print(f"{'-'*70}")
-
-            # Reconnect if connection was dropped by Gmail
-            for attempt in range(3):
+        # One FETCH for the whole batch; reconnect if Gmail drops the connection
+        for attempt in range(3):
+            try:
+                status, msg_data = mail.fetch(b','.join(email_ids), '(RFC822)')
+                break
+            except (imaplib.IMAP4.abort, OSError):
+                print(f"  Connection dropped, reconnecting (attempt {attempt+1})...")
                 try:
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
-                    break
-                except (imaplib.IMAP4.abort, OSError):
-                    print(f"  Connection dropped, reconnecting (attempt {attempt+1})...")
-                    try:
-                        mail = _imap_connect(gmail_user, gmail_password, folder)
-                    except Exception:
-                        pass
-            else:
-                print(f"✗ Could not fetch email {i} after 3 attempts, skipping.")
-                print()
-                continue
-
-            if not msg_data or not msg_data[0]:
-                print(f"✗ Empty response for email {i}, skipping.")
-                print()
-                continue
+                    mail = _imap_connect(gmail_user, gmail_password, folder)
+                except Exception:
+                    pass
+        else:
+            print("✗ Could not fetch emails after 3 attempts.")
+            print()
+            msg_data = []
+        
+        # Message parts come back as (b'<seq> (RFC822 {size}', raw) tuples
+        raw_by_id = {}
+        for part in msg_data or []:
+            if isinstance(part, tuple):
+                raw_by_id[part[0].split(None, 1)[0]] = part[1]
+        
+        # One SMTP session for every forward; reopened after a failure
+        smtp = None
+        try:
+            for i, email_id in enumerate(email_ids, 1):
+                print(f"{'-'*70}")
+                print(f"Processing email {i}/{len(email_ids)}...")
+                print(f"{'-'*70}")
 
-            raw_email = msg_data[0][1]
-            
-            msg = email.message_from_bytes(raw_email, policy=policy.default)
-            
-            print(f"From: {msg['From']}")
-            print(f"Subject: {msg['Subject']}")
-            print(f"Date: {msg['Date']}")
-            
-            try:
-                payload = raw_email if len(raw_email) <= 512_000 else raw_email[:512_000]
-                with smtplib.SMTP(smtp_host, smtp_port, timeout=15) as smtp:
+                raw_email = raw_by_id.get(email_id)
+                if not raw_email:
+                    print(f"✗ Empty response for email {i}, skipping.")
+                    print()
+                    continue
+                
+                msg = email.message_from_bytes(raw_email, policy=policy.default)
+                
+                print(f"From: {msg['From']}")
+                print(f"Subject: {msg['Subject']}")
+                print(f"Date: {msg['Date']}")
+                
+                try:
+                    payload = raw_email if len(raw_email) <= 512_000 else raw_email[:512_000]
+                    if smtp is None:
+                        smtp = smtplib.SMTP(smtp_host, smtp_port, timeout=15)
                     smtp.sendmail(gmail_user, [gmail_user], payload)
                     print(f"✓ Forwarded to {smtp_host}:{smtp_port}")
-            except Exception as e:
-                print(f"✗ Failed to forward: {e}")
-            
-            print()
+                except Exception as e:
+                    print(f"✗ Failed to forward: {e}")
+                    if smtp is not None:
+                        _close_smtp(smtp)
+                        smtp = None
+                
+                print()
+        finally:
+            if smtp is not None:
+                _close_smtp(smtp)
         
         try:
             mail.close()